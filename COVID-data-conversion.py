@@ -32,6 +32,18 @@ import os
 from glob import glob
 import sys
 from datetime import datetime
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+# pyarrow is optional. It's used to merge the chunks from the parallel loader without copying them, and for the
+# parquet store that lets a refresh only parse new daily reports.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 
 filepath = "./COVID-19/csse_covid_19_data/csse_covid_19_daily_reports"
@@ -43,23 +55,222 @@ daily_report_files = [file for file in glob(os.path.join(filepath,'*.csv'))]
 
 
 # +
-daily_reports = pd.DataFrame()
+# The column names changed a couple of times (see the notes at the top), so everything gets renamed to the
+# post 03/22 names and then reindexed onto one schema. Files from before a column existed just get NaN's.
+column_renames = {'Province/State':'Province_State',
+                  'Country/Region':'Country_Region',
+                  'Lat':'Latitude',
+                  'Long_':'Longitude',
+                  'Last Update':'Last_Update',
+                  'Incidence_Rate':'Incident_Rate',
+                  'Case-Fatality_Ratio':'Case_Fatality_Ratio'}
+
+daily_report_dtypes = {'FIPS':'float64',
+                       'Admin2':'object',
+                       'Province_State':'object',
+                       'Country_Region':'object',
+                       'Last_Update':'object',
+                       'Latitude':'float64',
+                       'Longitude':'float64',
+                       'Confirmed':'float64',
+                       'Deaths':'float64',
+                       'Recovered':'float64',
+                       'Active':'float64',
+                       'Combined_Key':'object',
+                       'Incident_Rate':'float64',
+                       'Case_Fatality_Ratio':'float64',
+                       'date_str':'object',
+                       'Date':'datetime64[ns]'}
+
+daily_report_columns = list(daily_report_dtypes)
+
+if pa is not None:
+    _arrow_types = {'float64':pa.float64(), 'object':pa.string(), 'datetime64[ns]':pa.timestamp('ns')}
+    daily_report_schema = pa.schema([(col, _arrow_types[dtype]) for col, dtype in daily_report_dtypes.items()])
+
+
+def read_daily_report(file):
+    """Read a single daily report and put it into the unified column format."""
+    file_date, file_ext = os.path.basename(file).split('.')
+    temp_df = pd.read_csv(file)
+    temp_df.rename(columns=column_renames, inplace=True)
+    temp_df = temp_df.reindex(columns=daily_report_columns)
+    temp_df['date_str'] = file_date
+    # The date is the same for the whole file, so only parse it once.
+    temp_df['Date'] = datetime.strptime(file_date, "%m-%d-%Y")
+    # Pinning the dtypes keeps every file (and every shard in parallel mode) on the same schema.
+    return temp_df.astype(daily_report_dtypes)
+
+
+def _read_daily_report_shard(files):
+    """Worker for the parallel loader. Reads a contiguous run of files and returns them as one chunk."""
+    frames = []
+    for file in files:
+        try:
+            frames.append(read_daily_report(file))
+        except Exception as ex:
+            print(repr(ex))
+
+    if not frames:
+        return None
+
+    chunk = pd.concat(frames, axis=0, ignore_index=True, sort=False)
+    if pa is not None:
+        return pa.Table.from_pandas(chunk, schema=daily_report_schema, preserve_index=False)
+    return chunk
+
+
+def load_daily_reports(files, workers=None, shards_per_worker=4):
+    """Read all of the daily reports and concatenate them in one go.
+
+    If workers is set, the (sorted) file list is split into contiguous shards that are read by a pool of that many
+    processes. With pyarrow installed each shard comes back as an Arrow table and the tables are merged without
+    copying before the single conversion back to pandas.
+    """
+    files = sorted(files)
+
+    if workers is None or workers <= 1 or len(files) < 2:
+        chunks = [_read_daily_report_shard(files)]
+    else:
+        n_shards = min(len(files), workers * shards_per_worker)
+        shard_sz = -(-len(files) // n_shards)
+        shards = [files[i:i+shard_sz] for i in range(0, len(files), shard_sz)]
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('fork')) as pool:
+            chunks = list(pool.map(_read_daily_report_shard, shards))
+
+    chunks = [chunk for chunk in chunks if chunk is not None]
+
+    if not chunks:
+        return pd.DataFrame(columns=daily_report_columns).astype(daily_report_dtypes)
+
+    if pa is not None and isinstance(chunks[0], pa.Table):
+        return pa.concat_tables(chunks).to_pandas()
+
+    return pd.concat(chunks, axis=0, ignore_index=True, sort=False)
 
-for file in daily_report_files:
+
+# Number of processes to use when reading the daily reports, None reads them in this process.
+load_workers = None
+
+# -
+
+# ## Incremental refresh
+# Rather than re-parsing every daily report on each run, each report is stored as its own parquet file in
+# `store_dir`, alongside a manifest of the size, modification time and hash of the CSV it came from. A refresh only
+# parses reports that are new or whose contents changed, and drops the stored copy of any report that disappeared.
+# Size and mtime are checked first so unchanged files don't even need to be hashed.
+
+# +
+store_dir = "./daily_reports_store"
+manifest_name = "_manifest.json"
+
+
+def file_hash(file, block_sz=1 << 20):
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_sz), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(store_dir):
     try:
-        file_date, file_ext = file.split('/')[-1].split('.')
-        temp_df = pd.read_csv(file)
-        temp_df['date_str'] = file_date
-        temp_df['Date'] = temp_df['date_str'].apply(lambda x: datetime.strptime(x, "%m-%d-%Y"))
-        temp_df.rename(columns = {'Province/State':'Province_State',
-                                  'Country/Region':'Country_Region',
-                                  'Lat':'Latitude',
-                                  'Long_':'Longitude',
-                                  'Last Update':'Last_Update'}, inplace = True)
-        daily_reports = daily_reports.append(temp_df)
+        with open(os.path.join(store_dir, manifest_name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(store_dir, manifest):
+    # Write then rename so a crash part way through can't leave a half written manifest behind.
+    tmp_file = os.path.join(store_dir, manifest_name + '.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, os.path.join(store_dir, manifest_name))
+
+
+def _store_daily_report(file, partition):
+    """Worker for the refresh. Parses a daily report and writes it to its parquet partition."""
+    try:
+        table = pa.Table.from_pandas(read_daily_report(file), schema=daily_report_schema, preserve_index=False)
     except Exception as ex:
         print(repr(ex))
-        pass
+        return False
+    pq.write_table(table, partition)
+    return True
+
+
+def refresh_daily_report_store(files, store_dir, workers=None):
+    """Bring the parquet store up to date with files and return the full set of daily reports.
+
+    Only files that are new or have changed since the last refresh are parsed.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = read_manifest(store_dir)
+    files = sorted(files)
+
+    new_manifest = {}
+    changed = []
+    for file in files:
+        key = os.path.basename(file)
+        stat = os.stat(file)
+        entry = {'path': file, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                 'partition': os.path.splitext(key)[0] + '.parquet'}
+        old_entry = manifest.get(key)
+
+        if old_entry is not None and old_entry['size'] == entry['size'] and old_entry['mtime'] == entry['mtime']:
+            entry['sha256'] = old_entry['sha256']
+        else:
+            entry['sha256'] = file_hash(file)
+            if old_entry is None or old_entry['sha256'] != entry['sha256']:
+                changed.append(key)
+        new_manifest[key] = entry
+
+    # Anything whose source file went away gets dropped from the store.
+    for key in set(manifest) - set(new_manifest):
+        partition = os.path.join(store_dir, manifest[key]['partition'])
+        if os.path.exists(partition):
+            os.remove(partition)
+
+    jobs = [(new_manifest[key]['path'], os.path.join(store_dir, new_manifest[key]['partition'])) for key in changed]
+    if workers is None or workers <= 1 or len(jobs) < 2:
+        stored = [_store_daily_report(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('fork')) as pool:
+            stored = list(pool.map(_store_daily_report, *zip(*jobs)))
+
+    # Files that couldn't be parsed stay out of the manifest so they get retried next time.
+    for key, ok in zip(changed, stored):
+        if not ok:
+            del new_manifest[key]
+
+    write_manifest(store_dir, new_manifest)
+    print("Parsed {} new or changed daily reports, {} unchanged".format(sum(stored), len(new_manifest) - sum(stored)))
+
+    return load_daily_report_store(store_dir, new_manifest)
+
+
+def load_daily_report_store(store_dir, manifest=None):
+    """Read the stored daily reports back in, in the same order load_daily_reports uses."""
+    if manifest is None:
+        manifest = read_manifest(store_dir)
+
+    tables = [pq.read_table(os.path.join(store_dir, manifest[key]['partition']), schema=daily_report_schema)
+              for key in sorted(manifest, key=lambda key: manifest[key]['path'])]
+
+    if not tables:
+        return pd.DataFrame(columns=daily_report_columns).astype(daily_report_dtypes)
+
+    return pa.concat_tables(tables).to_pandas()
+
+
+# +
+# The store needs pyarrow, without it everything is just parsed from scratch.
+if pa is not None:
+    daily_reports = refresh_daily_report_store(daily_report_files, store_dir, workers=load_workers)
+else:
+    daily_reports = load_daily_reports(daily_report_files, workers=load_workers)
 
 # daily_reports = [pd.read_csv(file) for file in daily_report_files]
 
@@ -121,3 +332,122 @@ daily_reports.query('FIPS != FIPS and Country_Region == "US"').Admin2.unique()
 
 
 
+
+# # Ingestion benchmark
+# Comparison of the original append loop against `load_daily_reports` on a synthetic set of daily reports. Each
+# loader runs in its own forked process so the peak RSS numbers don't bleed into each other. The parallel loaders'
+# workers are measured too, since their memory counts as much as the main process's. Set `run_benchmarks` to True
+# to run it.
+
+# +
+import time
+import tempfile
+import resource
+from functools import partial
+from datetime import timedelta
+
+run_benchmarks = False
+
+
+def load_daily_reports_append(files):
+    """The original loader, kept around for comparison. Grows the frame one file at a time."""
+    daily_reports = pd.DataFrame()
+
+    for file in files:
+        try:
+            file_date, file_ext = file.split('/')[-1].split('.')
+            temp_df = pd.read_csv(file)
+            temp_df['date_str'] = file_date
+            temp_df['Date'] = temp_df['date_str'].apply(lambda x: datetime.strptime(x, "%m-%d-%Y"))
+            temp_df.rename(columns = {'Province/State':'Province_State',
+                                      'Country/Region':'Country_Region',
+                                      'Lat':'Latitude',
+                                      'Long_':'Longitude',
+                                      'Last Update':'Last_Update'}, inplace = True)
+            # DataFrame.append is gone in newer versions of pandas, it was just a concat under the hood anyway.
+            daily_reports = pd.concat([daily_reports, temp_df])
+        except Exception as ex:
+            print(repr(ex))
+            pass
+
+    return daily_reports
+
+
+def make_synthetic_daily_reports(directory, n_files=1000, rows_per_file=3000, seed=0):
+    """Write n_files fake daily reports into directory, using the same format changes as the real data."""
+    rng = np.random.default_rng(seed)
+    start = datetime(2020, 1, 22)
+    files = []
+
+    for i in range(n_files):
+        day = start + timedelta(days=i)
+        n_rows = rows_per_file if day >= datetime(2020, 3, 22) else rows_per_file // 20
+        report = pd.DataFrame({'Confirmed': rng.integers(0, 100000, n_rows),
+                               'Deaths': rng.integers(0, 1000, n_rows),
+                               'Recovered': rng.integers(0, 10000, n_rows)})
+
+        if day < datetime(2020, 3, 22):
+            report.insert(0, 'Province/State', ['Province ' + str(x) for x in range(n_rows)])
+            report.insert(1, 'Country/Region', 'US')
+            report.insert(2, 'Last Update', day.isoformat())
+            if day >= datetime(2020, 3, 1):
+                report['Latitude'] = rng.uniform(-90, 90, n_rows)
+                report['Longitude'] = rng.uniform(-180, 180, n_rows)
+        else:
+            report.insert(0, 'FIPS', np.arange(n_rows) + 1000)
+            report.insert(1, 'Admin2', ['County ' + str(x) for x in range(n_rows)])
+            report.insert(2, 'Province_State', ['Province ' + str(x % 60) for x in range(n_rows)])
+            report.insert(3, 'Country_Region', 'US')
+            report.insert(4, 'Last_Update', day.isoformat())
+            report['Lat'] = rng.uniform(-90, 90, n_rows)
+            report['Long_'] = rng.uniform(-180, 180, n_rows)
+            report['Active'] = report['Confirmed'] - report['Deaths'] - report['Recovered']
+            report['Combined_Key'] = report['Admin2'] + ', ' + report['Province_State'] + ', US'
+            if day >= datetime(2020, 5, 29):
+                report['Incidence_Rate'] = rng.uniform(0, 5000, n_rows)
+                report['Case-Fatality_Ratio'] = rng.uniform(0, 10, n_rows)
+
+        file = os.path.join(directory, day.strftime("%m-%d-%Y") + '.csv')
+        report.to_csv(file, index=False)
+        files.append(file)
+
+    return files
+
+
+def _timed_load(loader, files, results):
+    start = time.perf_counter()
+    frame = loader(files)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux. RUSAGE_CHILDREN covers the pool workers (once they've exited), and it's the
+    # peak of the largest one rather than the total.
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, len(frame)))
+
+
+def benchmark_loader(loader, files):
+    """Run loader in a forked process and return (wall time in s, peak RSS in MB of the loading process and of its
+    largest worker (0 without workers), rows loaded)."""
+    ctx = mp.get_context('fork')
+    results = ctx.Queue()
+    proc = ctx.Process(target=_timed_load, args=(loader, files, results))
+    proc.start()
+    result = results.get()
+    proc.join()
+    return result
+
+
+if run_benchmarks:
+    with tempfile.TemporaryDirectory() as bench_dir:
+        bench_files = make_synthetic_daily_reports(bench_dir, n_files=1000)
+
+        loaders = [('append loop', load_daily_reports_append), ('single concat', load_daily_reports)]
+        loaders += [('{} workers'.format(n), partial(load_daily_reports, workers=n)) for n in (2, 4, 8, 16, 32)
+                    if n <= os.cpu_count()]
+
+        # Each worker's RSS includes the pages it shares with the parent after the fork, so main + workers x worker
+        # peak is an upper bound on the total.
+        for name, loader in loaders:
+            wall, rss, worker_rss, rows = benchmark_loader(loader, bench_files)
+            workers = getattr(loader, 'keywords', {}).get('workers', 0)
+            print("{:>14}: {:8.2f} s  {:8.1f} MB peak RSS main  {:8.1f} MB per worker  {:8.1f} MB total at most  "
+                  "{} rows".format(name, wall, rss, worker_rss, rss + workers * worker_rss, rows))
@@ -26,6 +26,16 @@
 
 import numpy as np # linear algebra
 import pandas as pd # data processing, CSV file I/O (e.g. pd.read_csv)
+import os
+import re
+import time
+from numpy.lib.stride_tricks import sliding_window_view
+
+# numba is optional, it's only used to speed up the rolling window functions below.
+try:
+    import numba
+except ImportError:
+    numba = None
 
 from matplotlib import pyplot as plt 
 from matplotlib import dates as mdates
@@ -39,22 +49,147 @@ import plotly as py
 init_notebook_mode(connected=True)
 import plotly.graph_objs as go
 
+import json
+import resource
+import tracemalloc
+
+class StageProfiler:
+    """Wall time, CPU time, peak memory and row counts for each stage of this notebook.
+    
+    Each stage() call ends the current stage and starts the next one, so the calls just go at the top of the cells
+    they're timing. When the profiler is disabled stage() returns straight away, so they can be left in.
+    
+    Peak memory is tracked with tracemalloc (numpy and pandas report their allocations to it), which slows
+    everything down a bit, so it can be turned off with track_memory. The process's max RSS is always recorded.
+    """
+    
+    def __init__(self, enabled=False, track_memory=True):
+        self.enabled = enabled
+        self.track_memory = track_memory
+        self.records = []
+        self._current = None
+        self._start = time.perf_counter()
+        
+        if enabled and track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+    
+    def stage(self, name, rows=None):
+        if not self.enabled:
+            return
+        self.finish()
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        self._current = (name, rows, time.perf_counter(), time.process_time())
+    
+    def finish(self):
+        """End the current stage without starting another one."""
+        if self._current is None:
+            return
+        name, rows, wall_start, cpu_start = self._current
+        wall_end, cpu_end = time.perf_counter(), time.process_time()
+        peak = tracemalloc.get_traced_memory()[1] if self.track_memory else None
+        self.records.append({'stage': name,
+                             'rows': rows,
+                             'start_s': wall_start - self._start,
+                             'wall_s': wall_end - wall_start,
+                             'cpu_s': cpu_end - cpu_start,
+                             'peak_mb': None if peak is None else peak / 2**20,
+                             # ru_maxrss is in kilobytes on Linux
+                             'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+        self._current = None
+    
+    def summary(self):
+        """Totals for each stage name, in the order the stages first ran."""
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(record['stage'], {'calls': 0, 'rows': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                        'peak_mb': None, 'max_rss_mb': 0.0})
+            total['calls'] += 1
+            total['rows'] += record['rows'] or 0
+            total['wall_s'] += record['wall_s']
+            total['cpu_s'] += record['cpu_s']
+            if record['peak_mb'] is not None:
+                total['peak_mb'] = max(total['peak_mb'] or 0, record['peak_mb'])
+            total['max_rss_mb'] = max(total['max_rss_mb'], record['max_rss_mb'])
+        return stages
+    
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'stages': self.summary(), 'records': self.records}, f, indent=1)
+    
+    def to_chrome_trace(self, path):
+        """Write the stages in the Chrome trace event format, for chrome://tracing or https://ui.perfetto.dev"""
+        pid = os.getpid()
+        events = []
+        for record in self.records:
+            events.append({'name': record['stage'], 'cat': 'stage', 'ph': 'X', 'pid': pid, 'tid': 0,
+                           'ts': record['start_s'] * 1e6, 'dur': record['wall_s'] * 1e6,
+                           'args': {key: record[key] for key in ('rows', 'cpu_s', 'peak_mb', 'max_rss_mb')}})
+            if record['peak_mb'] is not None:
+                events.append({'name': 'peak memory (MB)', 'ph': 'C', 'pid': pid, 'tid': 0,
+                               'ts': record['start_s'] * 1e6, 'args': {'peak_mb': record['peak_mb']}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+# Set COVID_PROFILE=1 to profile the stages, and COVID_PROFILE_OUTPUT to a file name prefix to save the results
+# (as <prefix>.json and <prefix>.trace.json). COVID_PROFILE_MEMORY=0 skips the memory tracking.
+profiler = StageProfiler(enabled=os.environ.get('COVID_PROFILE', '0') not in ('', '0'),
+                         track_memory=os.environ.get('COVID_PROFILE_MEMORY', '1') not in ('', '0'))
+stage = profiler.stage
+
 # Input data files are available in the "../input/" directory.
 # For example, running this (by clicking run or pressing Shift+Enter) will list all files under the input directory
+# The benchmark points COVID_INPUT_DIR at its synthetic data instead.
+input_dir = os.environ.get('COVID_INPUT_DIR', '../input')
 
-all_covid = pd.read_csv("../input/coronavirus-2019ncov/covid-19-all.csv")
+stage('load')
+all_covid = pd.read_csv(os.path.join(input_dir, "coronavirus-2019ncov/covid-19-all.csv"))
 
 # Additional county level data set
 
-us_counties_data = pd.read_csv("../input/us-counties-covid-19-dataset/us-counties.csv", dtype={'fips': object})
+def load_us_counties(path):
+    """Load the NYT county level data with compact types.
+    
+    county, state and fips are categoricals, date is a real datetime, and the counts are int32 (or float32 if a
+    column has missing values).
+    """
+    counties = pd.read_csv(path, parse_dates=['date'],
+                           dtype={'county': 'category', 'state': 'category', 'fips': 'category',
+                                  'cases': np.float32, 'deaths': np.float32})
+    
+    for col in ['cases', 'deaths']:
+        if counties[col].notna().all():
+            counties[col] = counties[col].astype(np.int32)
+    
+    return counties
+
+def combine_categories(first, second, sep=', '):
+    """Categorical of first + sep + second, only building the strings for the pairs that actually occur."""
+    n = len(second.cat.categories)
+    first_codes = first.cat.codes.to_numpy(dtype=np.int64)
+    second_codes = second.cat.codes.to_numpy(dtype=np.int64)
+    valid = (first_codes >= 0) & (second_codes >= 0)
+    
+    codes = np.full(len(first), -1, dtype=np.int64)
+    codes[valid], pairs = pd.factorize(first_codes[valid] * n + second_codes[valid], sort=True)
+    labels = first.cat.categories.take(pairs // n).astype(str) + sep + second.cat.categories.take(pairs % n).astype(str)
+    
+    return pd.Series(pd.Categorical.from_codes(codes, categories=labels), index=first.index, name=first.name)
+
+us_counties_path = os.path.join(input_dir, "us-counties-covid-19-dataset/us-counties.csv")
+us_counties_data = load_us_counties(us_counties_path)
 
 # Any results you write to the current directory are saved as output.
+
+# Set this to True to run the timing comparisons in the Benchmarks section at the bottom.
+run_benchmarks = False
 # -
 
 # # Data Cleaning
 
 # + _cell_guid="79c7e3d0-c299-4dcb-8224-4455121ee9b0" _uuid="d629ff2d2480ee46fbb7e2d37f6b5fab8052498a"
 # Data cleaning and sorting
+stage('clean', rows=len(all_covid))
 
 us_all = all_covid.loc[all_covid['Country/Region'].isin(['US'])]
 
@@ -70,27 +205,88 @@ us_all.drop(us_all.loc[us_all['Province/State'] == 'US'].index,inplace=True)
 us_all.drop(us_all.loc[us_all['Province/State'] == 'Recovered'].index,inplace=True)
 us_all.drop(us_all.loc[us_all['Province/State'].str.contains("Princess")].index,inplace=True)
 
-for state in state_abbrv:
-    us_all.loc[us_all.iloc[:,1].str.contains(state), 'Province/State'] = state_abbrv[state]
+def normalize_state_names_loop(us_all, state_abbrv):
+    """Original version, one str.contains scan over the whole frame per key. Kept for comparison."""
+    for state in state_abbrv:
+        us_all.loc[us_all.iloc[:,1].str.contains(state), 'Province/State'] = state_abbrv[state]
+
+def normalize_state_names(provinces, state_abbrv):
+    """Map Province/State values (abbreviations, "King County, WA", "Chicago", etc.) to full state names.
+    
+    Gives the same result as the loop above, where every key is checked in order and later matches win, but the
+    check is done once per unique value and then mapped back onto the rows with a single lookup.
+    """
+    codes, uniques = pd.factorize(provinces)
+    
+    any_state = re.compile('|'.join('(?:{})'.format(key) for key in state_abbrv))
+    state_patterns = [(re.compile(key), state_abbrv[key]) for key in state_abbrv]
+    
+    lookup = np.empty(len(uniques) + 1, dtype=object)
+    lookup[-1] = np.nan # factorize uses -1 for missing values
+    for i, value in enumerate(uniques):
+        if any_state.search(value):
+            for pattern, name in state_patterns:
+                if pattern.search(value):
+                    value = name
+        lookup[i] = value
+    
+    return pd.Series(lookup[codes], index=provinces.index, name=provinces.name)
+
+us_all['Province/State'] = normalize_state_names(us_all['Province/State'], state_abbrv)
 
 state_list = np.sort(us_all['Province/State'].unique())
 
 date_list = pd.to_datetime(us_all.Date.unique())
 
-us_confirmed = pd.DataFrame(index=date_list)
-us_deaths = pd.DataFrame(index=date_list)
-us_recovered = pd.DataFrame(index=date_list)
+# Which way to build the date x state matrices: 'pivot' (one grouped pivot), 'loop' (my original per-state joins),
+# or 'compare' to build both and check that they agree.
+state_matrix_method = 'pivot'
 
+def build_state_matrices_loop(us_all, state_list, date_list):
+    """Original per-state version. Returns the confirmed, deaths and recovered date x state frames."""
+    us_confirmed = pd.DataFrame(index=date_list)
+    us_deaths = pd.DataFrame(index=date_list)
+    us_recovered = pd.DataFrame(index=date_list)
+    
+    # Note: This is my old way of doing things, I'm leaving it in because I'm reasonable confident it works and it makes for a good comparison against my newer method.
+    for state in state_list:
+        cur_state = us_all.loc[us_all['Province/State']==state,['Confirmed', 'Recovered', 'Deaths', 'Date']].groupby('Date').sum()
+        # The dates in the file are strings, so they have to match the type of date_list for the join to line up.
+        cur_state.index = pd.to_datetime(cur_state.index)
+        us_confirmed = us_confirmed.join(cur_state['Confirmed'])
+        us_confirmed.rename(columns={'Confirmed':state}, inplace=True)
+        us_deaths = us_deaths.join(cur_state['Deaths'])
+        us_deaths.rename(columns={'Deaths':state}, inplace=True)
+        us_recovered = us_recovered.join(cur_state['Recovered'])
+        us_recovered.rename(columns={'Recovered':state}, inplace=True)
+    
+    return us_confirmed, us_deaths, us_recovered
 
-# Note: This is my old way of doing things, I'm leaving it in because I'm reasonable confident it works and it makes for a good comparison against my newer method.
-for state in state_list:
-    cur_state = us_all.loc[us_all['Province/State']==state,['Confirmed', 'Recovered', 'Deaths', 'Date']].groupby('Date').sum()
-    us_confirmed = us_confirmed.join(cur_state['Confirmed'])
-    us_confirmed.rename(columns={'Confirmed':state}, inplace=True)
-    us_deaths = us_deaths.join(cur_state['Deaths'])
-    us_deaths.rename(columns={'Deaths':state}, inplace=True)
-    us_recovered = us_recovered.join(cur_state['Recovered'])
-    us_recovered.rename(columns={'Recovered':state}, inplace=True)
+def build_state_matrices(us_all, state_list, date_list, dtype=np.float32):
+    """Build the confirmed, deaths and recovered date x state frames from a single grouped pivot.
+    
+    float32 holds every count exactly up to ~16.7 million, and halves the memory of the three frames.
+    """
+    case_types = ['Confirmed', 'Deaths', 'Recovered']
+    totals = us_all.groupby(['Date', 'Province/State'])[case_types].sum().unstack('Province/State')
+    totals.index = pd.to_datetime(totals.index)
+    totals = totals.reindex(index=date_list)
+    
+    return tuple(totals[case_type].reindex(columns=state_list).astype(dtype) for case_type in case_types)
+
+stage('state pivot', rows=len(us_all))
+if state_matrix_method == 'loop':
+    us_confirmed, us_deaths, us_recovered = build_state_matrices_loop(us_all, state_list, date_list)
+else:
+    us_confirmed, us_deaths, us_recovered = build_state_matrices(us_all, state_list, date_list)
+
+if state_matrix_method == 'compare':
+    for name, old, new in zip(['Confirmed', 'Deaths', 'Recovered'],
+                              build_state_matrices_loop(us_all, state_list, date_list),
+                              (us_confirmed, us_deaths, us_recovered)):
+        same = old.columns.equals(new.columns) and old.index.equals(new.index) and \
+               np.allclose(old.to_numpy(dtype=np.float64), new.to_numpy(dtype=np.float64), equal_nan=True)
+        print("{}: loop and pivot match: {}".format(name, same))
     
 #us_all.loc[us_all['Province/State']=='Washington',['Confirmed', 'Recovered', 'Deaths', 'Date']].groupby('Date').sum()
 # -
@@ -99,6 +295,7 @@ for state in state_list:
 
 # +
 # Counties level data set cleaning
+stage('clean', rows=len(us_counties_data))
 
 us_counties_data = us_counties_data.rename(columns={'date':'Date',
                                                     'county':'County',
@@ -109,7 +306,7 @@ us_counties_data = us_counties_data.rename(columns={'date':'Date',
 
 
 #us_counties_data.drop(us_counties_data['FIPS'].isna().index)
-us_counties_data['County_and_State'] = us_counties_data['County'] + ', ' + us_counties_data['Province/State']
+us_counties_data['County_and_State'] = combine_categories(us_counties_data['County'], us_counties_data['Province/State'])
 
 us_counties_data.drop(us_counties_data.loc[us_counties_data['FIPS'].isna()].index,inplace=True)
 
@@ -123,6 +320,7 @@ us_counties_data.drop(us_counties_data.loc[us_counties_data['FIPS'].isna()].inde
 
 # +
 # Calculations 
+stage('rolling features', rows=len(us_counties_data))
 us_death_dt = us_deaths.diff()
 us_death_dt2 = us_death_dt.diff()
 
@@ -131,38 +329,143 @@ us_confirmed_dt2 = us_confirmed_dt.diff()
 
 
 # +
-state_grp_orig = us_all.groupby(['Province/State','Date'], as_index=False).sum()
-state_grp = us_counties_data.groupby(['Province/State', 'Date'], as_index=False).sum()
-#state_grp2.loc[state_grp2['Province/State'] == 'New York'].groupby('Date').first()
-
-state_grp['Confirmed_dt'] = state_grp.groupby(['Province/State'])['Confirmed'].diff().rolling(7).mean()
-#state_grp['Recovered_dt'] = state_grp.groupby(['Province/State'])['Recovered'].diff().rolling(6).mean()
-state_grp['Deaths_dt'] = state_grp.groupby(['Province/State'])['Deaths'].diff().rolling(7).mean()
-
-us_counties_data['Confirmed_dt'] = us_counties_data.groupby(['County_and_State'])['Confirmed'].diff().rolling(7).mean()
-us_counties_data['Deaths_dt'] = us_counties_data.groupby(['County_and_State'])['Deaths'].diff().rolling(7).mean()
-
-
-
-state_grp['Confirmed_dt2'] = state_grp.groupby(['Province/State'])['Confirmed_dt'].diff()
-#state_grp['Recovered_dt2'] = state_grp.groupby(['Province/State'])['Recovered_dt'].diff()
-state_grp['Deaths_dt2'] = state_grp.groupby(['Province/State'])['Deaths_dt'].diff()
-
-us_counties_data['Confirmed_dt2'] = us_counties_data.groupby(['County_and_State'])['Confirmed_dt'].diff()
-us_counties_data['Deaths_dt2'] = us_counties_data.groupby(['County_and_State'])['Deaths_dt'].diff()
+# Rolling window functions for grouped data.
+# The data has to be sorted so that each group (state, county, etc.) is a contiguous run of rows, and the groups
+# are described by their start offsets plus the total length at the end, e.g. [0, 120, 245, ..., n]. Every
+# function returns a result for every row of every group at once, with NaN wherever the window isn't full yet
+# within its own group or contains a NaN (the same as pandas' .rolling(window) on each group).
+
+def group_offsets(keys):
+    """Start offset of each run of equal keys, plus the total length at the end."""
+    codes = pd.factorize(keys)[0]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.zeros(0, dtype=np.int64)
+    return np.r_[starts, len(codes)].astype(np.int64)
+
+def group_positions(offsets):
+    """Position of each row within its group."""
+    return np.arange(offsets[-1]) - np.repeat(offsets[:-1], np.diff(offsets))
+
+def _rolling_numpy(values, offsets, window, reduce, chunk_sz=1 << 20):
+    # Pad the front so there's a window ending at every row, then reduce a chunk of windows at a time so
+    # things like np.median don't have to copy all of them at once.
+    windows = sliding_window_view(np.concatenate([np.full(window - 1, np.nan), values]), window)
+    out = np.empty(len(values))
+    for i in range(0, len(values), chunk_sz):
+        reduce(windows[i:i+chunk_sz], axis=1, out=out[i:i+chunk_sz])
+    out[group_positions(offsets) < window - 1] = np.nan
+    return out
+
+if numba is not None:
+    @numba.njit
+    def _rolling_sum_numba(values, offsets, window):
+        out = np.full(values.shape[0], np.nan)
+        for g in range(offsets.shape[0] - 1):
+            for i in range(offsets[g] + window - 1, offsets[g+1]):
+                total = 0.0
+                for j in range(i - window + 1, i + 1):
+                    total += values[j]
+                out[i] = total # NaN's carry through the sum on their own
+        return out
+    
+    @numba.njit
+    def _rolling_median_numba(values, offsets, window):
+        out = np.full(values.shape[0], np.nan)
+        buf = np.empty(window)
+        for g in range(offsets.shape[0] - 1):
+            for i in range(offsets[g] + window - 1, offsets[g+1]):
+                # Insertion sort into buf, windows are small enough that this beats anything fancier.
+                n = 0
+                for j in range(i - window + 1, i + 1):
+                    v = values[j]
+                    if np.isnan(v):
+                        break
+                    k = n
+                    while k > 0 and buf[k-1] > v:
+                        buf[k] = buf[k-1]
+                        k -= 1
+                    buf[k] = v
+                    n += 1
+                if n == window:
+                    out[i] = buf[window // 2] if window % 2 else 0.5 * (buf[window//2 - 1] + buf[window // 2])
+        return out
+
+def rolling_sum(values, offsets, window):
+    # pandas' rolling windows treat inf (e.g. growth from 0 cases) as missing, so do the same here.
+    values = np.asarray(values, dtype=np.float64)
+    values = np.where(np.isfinite(values), values, np.nan)
+    if numba is not None:
+        return _rolling_sum_numba(values, offsets, window)
+    return _rolling_numpy(values, offsets, window, np.sum)
+
+def rolling_mean(values, offsets, window):
+    return rolling_sum(values, offsets, window) / window
+
+def rolling_median(values, offsets, window):
+    # Same inf handling as rolling_sum.
+    values = np.asarray(values, dtype=np.float64)
+    values = np.where(np.isfinite(values), values, np.nan)
+    if numba is not None:
+        return _rolling_median_numba(values, offsets, window)
+    return _rolling_numpy(values, offsets, window, np.median)
+
+def rolling_count(condition, offsets, window):
+    """Number of rows in the window where condition is True."""
+    return rolling_sum(np.asarray(condition, dtype=np.float64), offsets, window)
 
-state_grp['Confirmed_pct'] = state_grp.groupby(['Province/State'])['Confirmed'].pct_change() + 1
-state_grp['Neg_Confirmed_dt2'] = state_grp.groupby(['Province/State'])['Confirmed_dt2'].apply(lambda x: (x < 0).rolling(14).sum())
-state_grp['Mean_Confirmed_dt2'] = state_grp.groupby(['Province/State'])['Confirmed_dt2'].transform(lambda x: x.rolling(14).mean())
 
-state_grp['Deaths_pct'] = state_grp.groupby(['Province/State'])['Deaths'].pct_change() + 1
-state_grp['Neg_Deaths_dt2'] = state_grp.groupby(['Province/State'])['Deaths_dt2'].apply(lambda x: (x < 0).rolling(14).sum())
-state_grp['Mean_Deaths_dt2'] = state_grp.groupby(['Province/State'])['Deaths_dt2'].transform(lambda x: x.rolling(14).mean())
+# +
+state_grp_orig = us_all.groupby(['Province/State','Date'], as_index=False).sum()
+state_grp = us_counties_data.groupby(['Province/State', 'Date'], as_index=False, observed=True)[['Confirmed', 'Deaths']].sum()
+#state_grp2.loc[state_grp2['Province/State'] == 'New York'].groupby('Date').first()
 
+def add_trend_features(data, group_col, case_types=('Confirmed', 'Deaths'), window=7, trend_window=14):
+    """Add the derivative, growth and trend columns for each case type, computed separately for each group.
+    
+    For each case type this adds:
+        _dt: window day rolling mean of the daily difference
+        _dt2: daily difference of _dt
+        _pct: daily growth ratio (today / yesterday)
+        Neg_*_dt2: number of the last trend_window days where _dt2 was negative
+        Mean_*_dt2: trend_window day rolling mean of _dt2
+        Median_*_pct: trend_window day rolling median of _pct
+    
+    The frame is sorted by (group, Date) once, so every group is a contiguous run of rows and all of the columns
+    can be computed over the whole frame at once with the rolling functions above, which keep every window
+    inside its own group.
+    """
+    data = data.sort_values([group_col, 'Date'], kind='stable').reset_index(drop=True)
+    
+    offsets = group_offsets(data[group_col])
+    pos = group_positions(offsets)
+    
+    def group_diff(values):
+        out = np.empty_like(values)
+        out[1:] = values[1:] - values[:-1]
+        out[pos < 1] = np.nan
+        return out
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for case_type in case_types:
+            values = data[case_type].to_numpy(dtype=np.float64)
+            
+            dt = rolling_mean(group_diff(values), offsets, window)
+            dt2 = group_diff(dt)
+            
+            pct = np.empty_like(values)
+            pct[1:] = values[1:] / values[:-1]
+            pct[pos < 1] = np.nan
+            
+            data[case_type+'_dt'] = dt
+            data[case_type+'_dt2'] = dt2
+            data[case_type+'_pct'] = pct
+            data['Neg_'+case_type+'_dt2'] = rolling_count(dt2 < 0, offsets, trend_window)
+            data['Mean_'+case_type+'_dt2'] = rolling_mean(dt2, offsets, trend_window)
+            data['Median_'+case_type+'_pct'] = rolling_median(pct, offsets, trend_window)
+    
+    return data
 
-us_counties_data['Confirmed_pct'] = us_counties_data.groupby(['County_and_State'])['Confirmed'].pct_change() + 1
-us_counties_data['Neg_Confirmed_dt2'] = us_counties_data.groupby(['County_and_State'])['Confirmed_dt2'].apply(lambda x: (x < 0).rolling(14).sum())
-us_counties_data['Mean_Confirmed_dt2'] = us_counties_data.groupby(['County_and_State'])['Confirmed_dt2'].transform(lambda x: x.rolling(14).mean())
+state_grp = add_trend_features(state_grp, 'Province/State')
+us_counties_data = add_trend_features(us_counties_data, 'County_and_State')
 
 
 #state_grp['Mean_Confirmed_dt2'] = state_grp['Mean_Confirmed_dt2'].div(state_grp['Confirmed'])*10000
@@ -174,32 +477,92 @@ us_counties_data['Mean_Confirmed_dt2'] = us_counties_data.groupby(['County_and_S
 # States with a low case growth percentage and a high deceleration are doing well. 
 
 # + _kg_hide-input=true
-def calculate_recent_trends(dataset, columns, case_type='Confirmed'):
-    last_pct = pd.pivot_table(dataset,values=case_type+'_pct',index='Date',columns=columns).rolling(14).median().tail(1).T
+def latest_window_stats(dataset, columns, case_type='Confirmed', window=14):
+    """Recent trend statistics computed straight from the last window days of each location.
+    
+    Only the rows for the last window dates are used, so this never builds the full date x location pivot and
+    doesn't need the rolling columns from add_trend_features, just the _pct, _dt and _dt2 columns. A statistic is
+    NaN unless the location has a value for every one of those days, the same as a full rolling window.
+    
+    dataset has to be sorted by location and Date, the way add_trend_features leaves it. Then only the last window
+    rows of each location are looked at, so the work grows with the number of locations rather than the history.
+    """
+    keys = dataset[columns[0]] if len(columns) == 1 else pd.MultiIndex.from_frame(dataset[columns])
+    offsets = group_offsets(keys)
+    
+    # The last window rows of every group. Any of the last window dates that has data is in there for some group.
+    ends = offsets[1:]
+    starts = np.maximum(ends - window, offsets[:-1])
+    lengths = ends - starts
+    tail_rows = np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths) + np.arange(lengths.sum())
+    tail = dataset.iloc[tail_rows][columns + ['Date', case_type, case_type+'_dt', case_type+'_dt2', case_type+'_pct']]
+    
+    recent_dates = np.sort(tail['Date'].unique())[-window:]
+    recent = tail.loc[tail['Date'] >= recent_dates[0]]
+    
+    pct = recent[case_type+'_pct']
+    dt2 = recent[case_type+'_dt2']
+    recent = recent.assign(pct=pct.where(np.isfinite(pct)), neg_dt2=dt2 < 0, dt2=dt2)
+    
+    grouped = recent.groupby(columns, observed=True)
+    counts = grouped[['Date', 'pct', 'dt2']].count()
+    
+    stats = pd.DataFrame(index=counts.index)
+    stats['Case_growth'] = grouped['pct'].median().where(counts['pct'] == window)
+    stats['Case_deceleration'] = grouped['neg_dt2'].sum().where(counts['Date'] == window) / window * 100
+    stats['Avg_Case_acceleration'] = grouped['dt2'].mean().where(counts['dt2'] == window)
+    
+    latest = recent.loc[recent['Date'] == recent_dates[-1]].groupby(columns, observed=True)[[case_type, case_type+'_dt']].last()
+    stats['Latest_Case_totals'] = latest[case_type]
+    stats['New_Daily_Cases'] = latest[case_type+'_dt']
+    
+    return stats
+
+def format_recent_trends(stats):
+    """Round and format the recent trend statistics for display."""
+    recent_trends = stats[['Case_growth', 'Case_deceleration', 'Avg_Case_acceleration']].astype(np.float64)
+    recent_trends['Latest_Case_totals'] = stats['Latest_Case_totals'].map('{:,.1f}'.format)
+    recent_trends['New_Daily_Cases'] = stats['New_Daily_Cases'].map('{:,.0f}'.format)
+    
+    recent_trends = recent_trends.round({'Case_growth':4, 'Case_deceleration':2, 'Avg_Case_acceleration':2})
+
+    for col in recent_trends:
+        recent_trends[col] = recent_trends[col].astype(str)
+
+    return recent_trends
+
+def build_hover_text(frame, fields, sep='</br>'):
+    """Hover text for every row of frame, from a list of (label, column) pairs, in one vectorized pass."""
+    parts = [label + frame[col].astype(str) for label, col in fields]
+    return parts[0].str.cat(parts[1:], sep=sep)
+
+def calculate_recent_trends(dataset, columns, case_type='Confirmed', tail_only=False):
+    """Trend statistics over the last 14 days for each location.
+    
+    By default this reads the last row of the rolling columns from add_trend_features out of date x location
+    pivots. With tail_only the statistics are computed from just the last 14 days of data instead, which is
+    much cheaper for the county data.
+    """
+    if tail_only:
+        return format_recent_trends(latest_window_stats(dataset, columns, case_type))
+    
+    # The rolling median is already done per location by add_trend_features, so only the last row is needed here.
+    last_pct = pd.pivot_table(dataset,values='Median_'+case_type+'_pct',index='Date',columns=columns,observed=True).tail(1).T
     last_pct.columns = ['Case_growth']
 
-    neg_dt2 = pd.pivot_table(dataset,values='Neg_'+case_type+'_dt2',index='Date',columns=columns).tail(1).T/14*100
+    neg_dt2 = pd.pivot_table(dataset,values='Neg_'+case_type+'_dt2',index='Date',columns=columns,observed=True).tail(1).T/14*100
     neg_dt2.columns = ['Case_deceleration']
 
-    avg_accel = pd.pivot_table(dataset,values='Mean_'+case_type+'_dt2',index='Date',columns=columns).tail(1).T
+    avg_accel = pd.pivot_table(dataset,values='Mean_'+case_type+'_dt2',index='Date',columns=columns,observed=True).tail(1).T
     avg_accel.columns = ['Avg_Case_acceleration']
 
-    latest_cases = pd.pivot_table(dataset,values=case_type,index='Date',columns=columns).tail(1).T
+    latest_cases = pd.pivot_table(dataset,values=case_type,index='Date',columns=columns,observed=True).tail(1).T
     latest_cases.columns = ['Latest_Case_totals'] 
-    latest_cases['Latest_Case_totals'] = latest_cases['Latest_Case_totals'].map('{:,.1f}'.format)
 
-    new_cases = pd.pivot_table(dataset,values=case_type+'_dt',index='Date',columns=columns).tail(1).T
+    new_cases = pd.pivot_table(dataset,values=case_type+'_dt',index='Date',columns=columns,observed=True).tail(1).T
     new_cases.columns = ['New_Daily_Cases']
-    new_cases['New_Daily_Cases'] = new_cases['New_Daily_Cases'].map('{:,.0f}'.format)
-
-    recent_trends = last_pct.join(neg_dt2).join(avg_accel).join(latest_cases).join(new_cases)
-
-    recent_trends = recent_trends.round({'Case_growth':4, 'Case_deceleration':2, 'Avg_Case_acceleration':2})
-
-    for col in recent_trends:
-        recent_trends[col] = recent_trends[col].astype(str)
 
-    return recent_trends
+    return format_recent_trends(last_pct.join(neg_dt2).join(avg_accel).join(latest_cases).join(new_cases))
 
 
 # + _kg_hide-input=true _kg_hide-output=true
@@ -212,6 +575,7 @@ def test_callback(trace, points, selector):
 
 
 # + _kg_hide-input=true
+stage('recent trends', rows=len(state_grp))
 recent_trends = calculate_recent_trends(state_grp, ['Province/State'])
 
 reverse_abrv = dict((v, k) for k, v in state_abbrv.items())
@@ -221,11 +585,12 @@ reverse_abrv['Illinois'] = 'IL'
 [key for key in state_abbrv.keys() if state_abbrv[key] in recent_trends.index]
 
 recent_trends['state_abrvs'] = [reverse_abrv[state] if state in reverse_abrv else state for state in recent_trends.index]
-recent_trends['text'] = 'Total Confirmed Cases: ' + recent_trends['Latest_Case_totals'] + '</br>' + \
-                        'New Daily Cases: ' + recent_trends['New_Daily_Cases'] + '</br>' + \
-                        'Case Growth Rate: ' + recent_trends['Case_growth'] + '</br>' + \
-                        'Average Case Acceleration: ' + recent_trends['Avg_Case_acceleration']
+recent_trends['text'] = build_hover_text(recent_trends, [('Total Confirmed Cases: ', 'Latest_Case_totals'),
+                                                         ('New Daily Cases: ', 'New_Daily_Cases'),
+                                                         ('Case Growth Rate: ', 'Case_growth'),
+                                                         ('Average Case Acceleration: ', 'Avg_Case_acceleration')])
 
+stage('figure build')
 fig = go.Figure(data=go.Choropleth(
     locations=recent_trends['state_abrvs'], # Spatial coordinates
     text = recent_trends['text'],
@@ -238,7 +603,7 @@ fig = go.Figure(data=go.Choropleth(
 ))
 
 fig.update_layout(
-    title_text = 'Confirmed Case Recent Trends for the last 14 days, as of ' + state_grp['Date'].max()+'. <br>States are colored by the percentage of the last 14 days that case growth has slowed.',
+    title_text = 'Confirmed Case Recent Trends for the last 14 days, as of ' + state_grp['Date'].max().strftime('%Y-%m-%d')+'. <br>States are colored by the percentage of the last 14 days that case growth has slowed.',
     geo_scope='usa', # limit map scope to USA
 )
 
@@ -249,6 +614,7 @@ fig.show()
 
 
 # +
+stage('recent trends', rows=len(state_grp))
 recent_trends_deaths = calculate_recent_trends(state_grp, ['Province/State'], case_type='Deaths')
 
 reverse_abrv = dict((v, k) for k, v in state_abbrv.items())
@@ -258,11 +624,12 @@ reverse_abrv['Illinois'] = 'IL'
 [key for key in state_abbrv.keys() if state_abbrv[key] in recent_trends_deaths.index]
 
 recent_trends_deaths['state_abrvs'] = [reverse_abrv[state] if state in reverse_abrv else state for state in recent_trends_deaths.index]
-recent_trends_deaths['text'] = 'Total Confirmed Fatalities: ' + recent_trends_deaths['Latest_Case_totals'] + '</br>' + \
-                        'New Daily Fatalities: ' + recent_trends_deaths['New_Daily_Cases'] + '</br>' + \
-                        'Fatality Growth Rate: ' + recent_trends_deaths['Case_growth'] + '</br>' + \
-                        'Average Fatality Acceleration: ' + recent_trends_deaths['Avg_Case_acceleration']
+recent_trends_deaths['text'] = build_hover_text(recent_trends_deaths, [('Total Confirmed Fatalities: ', 'Latest_Case_totals'),
+                                                                       ('New Daily Fatalities: ', 'New_Daily_Cases'),
+                                                                       ('Fatality Growth Rate: ', 'Case_growth'),
+                                                                       ('Average Fatality Acceleration: ', 'Avg_Case_acceleration')])
 
+stage('figure build')
 fig_deaths = go.Figure(data=go.Choropleth(
     locations=recent_trends_deaths['state_abrvs'], # Spatial coordinates
     text = recent_trends_deaths['text'],
@@ -275,7 +642,7 @@ fig_deaths = go.Figure(data=go.Choropleth(
 ))
 
 fig_deaths.update_layout(
-    title_text = 'Fatality Recent Trends for the last 14 days, as of ' + state_grp['Date'].max()+'. <br>States are colored by the percentage of the last 14 days that fatality growth has slowed.',
+    title_text = 'Fatality Recent Trends for the last 14 days, as of ' + state_grp['Date'].max().strftime('%Y-%m-%d')+'. <br>States are colored by the percentage of the last 14 days that fatality growth has slowed.',
     geo_scope='usa', # limit map scope to USA
 )
 
@@ -289,15 +656,248 @@ fig_deaths.show()
 #
 
 # +
-county_recent_trends = calculate_recent_trends(us_counties_data, ['County_and_State'])
+stage('recent trends', rows=len(us_counties_data))
+county_recent_trends = calculate_recent_trends(us_counties_data, ['County_and_State'], tail_only=True)
 
 county_recent_trends = county_recent_trends.join(us_counties_data[['FIPS','County_and_State']].set_index('County_and_State').drop_duplicates())
 # -
 
-from urllib.request import urlopen
-import json
-with urlopen('https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json') as response:
-    counties = json.load(response)
+# ### Daily updates
+# Recomputing everything above from scratch every day is wasteful when only one day of data is new. The updater
+# below keeps the last 14 days of `_pct`, `_dt` and `_dt2` (plus the last 7 daily differences and the latest
+# total) for each location, which is everything the recent trends need. Applying a new day only touches the
+# locations in that day's rows, and the state can be saved to disk and loaded back the next day.
+
+# +
+class RecentTrendsUpdater:
+    """Incrementally maintained recent trend statistics for one case type.
+    
+    Arguments:
+        locations: Location names (states, County_and_State, etc.)
+        column: Name of the location column in the data
+        case_type: 'Confirmed' or 'Deaths'
+        window: Number of days the trend statistics cover
+        diff_window: Number of days in the rolling mean used for _dt
+    """
+    
+    def __init__(self, locations, column, case_type='Confirmed', window=14, diff_window=7):
+        self.column = column
+        self.case_type = case_type
+        self.window = window
+        self.diff_window = diff_window
+        self.last_date = None
+        self.locations = pd.Index([])
+        self._add_locations(locations)
+    
+    def _add_locations(self, locations):
+        new = pd.Index(np.asarray(locations, dtype=object)).difference(self.locations)
+        if len(new) == 0:
+            return
+        n = len(new)
+        
+        def grow(name, dtype, fill, *shape):
+            block = np.full((n,) + shape, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            setattr(self, name, block if old is None else np.concatenate([old, block]))
+        
+        # Each location's history is kept in ring buffers, with its day number i stored in slot i % size.
+        grow('days', np.int64, 0)
+        grow('last_value', np.float64, np.nan)
+        grow('last_seen', 'datetime64[ns]', np.datetime64('NaT'))
+        grow('diffs', np.float64, np.nan, self.diff_window)
+        grow('pct', np.float64, np.nan, self.window)
+        grow('dt', np.float64, np.nan, self.window)
+        grow('dt2', np.float64, np.nan, self.window)
+        self.locations = self.locations.append(new)
+    
+    @classmethod
+    def from_dataset(cls, dataset, column, case_type='Confirmed', window=14, diff_window=7):
+        """Build the updater from a dataset that already has the add_trend_features columns."""
+        updater = cls(dataset[column].unique(), column, case_type, window, diff_window)
+        
+        data = dataset.sort_values([column, 'Date'], kind='stable')
+        groups = data.groupby(column, sort=False, observed=True)
+        idx = updater.locations.get_indexer(data[column])
+        
+        # Day number of each row, counted from the start of its location's history.
+        day = groups.cumcount().to_numpy()
+        updater.days[idx] = day + 1
+        
+        diffs = data[case_type].diff().to_numpy(dtype=np.float64, copy=True)
+        diffs[day == 0] = np.nan
+        pct = data[case_type+'_pct'].to_numpy(dtype=np.float64)
+        
+        # Writing every row into its slot in order leaves the newest values in the ring buffers.
+        last = updater.days[idx] - day <= window
+        updater.pct[idx[last], day[last] % window] = np.where(np.isfinite(pct[last]), pct[last], np.nan)
+        updater.dt[idx[last], day[last] % window] = data[case_type+'_dt'].to_numpy(dtype=np.float64)[last]
+        updater.dt2[idx[last], day[last] % window] = data[case_type+'_dt2'].to_numpy(dtype=np.float64)[last]
+        last = updater.days[idx] - day <= diff_window
+        updater.diffs[idx[last], day[last] % diff_window] = diffs[last]
+        
+        latest = groups.tail(1)
+        latest_idx = updater.locations.get_indexer(latest[column])
+        updater.last_value[latest_idx] = latest[case_type].to_numpy(dtype=np.float64)
+        updater.last_seen[latest_idx] = pd.to_datetime(latest['Date']).to_numpy()
+        updater.last_date = pd.to_datetime(data['Date'].max())
+        
+        return updater
+    
+    def update(self, day_data):
+        """Apply one new day of data, with one row per location and the cumulative case_type totals."""
+        self._add_locations(day_data[self.column].unique())
+        idx = self.locations.get_indexer(day_data[self.column])
+        value = day_data[self.case_type].to_numpy(dtype=np.float64)
+        day = self.days[idx]
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            diff = value - self.last_value[idx]
+            pct = value / self.last_value[idx]
+        self.diffs[idx, day % self.diff_window] = diff
+        
+        dt = self.diffs[idx].mean(axis=1)
+        dt2 = dt - self.dt[idx, (day - 1) % self.window]
+        
+        self.pct[idx, day % self.window] = np.where(np.isfinite(pct), pct, np.nan)
+        self.dt[idx, day % self.window] = dt
+        self.dt2[idx, day % self.window] = dt2
+        
+        self.days[idx] += 1
+        self.last_value[idx] = value
+        self.last_seen[idx] = pd.to_datetime(day_data['Date']).to_numpy()
+        self.last_date = pd.to_datetime(day_data['Date'].max())
+    
+    def stats(self):
+        """Recent trend statistics for every location that has data on the latest date.
+        
+        Same columns as latest_window_stats, so the result can go through format_recent_trends.
+        """
+        current = self.last_seen == self.last_date
+        full = self.days[current] >= self.window
+        
+        stats = pd.DataFrame(index=pd.Index(self.locations[current], name=self.column))
+        # A NaN anywhere in the window makes the median and mean NaN, same as a rolling window.
+        stats['Case_growth'] = np.median(self.pct[current], axis=1)
+        stats['Case_deceleration'] = np.where(full, (self.dt2[current] < 0).sum(axis=1) / self.window * 100, np.nan)
+        stats['Avg_Case_acceleration'] = self.dt2[current].mean(axis=1)
+        stats['Latest_Case_totals'] = self.last_value[current]
+        stats['New_Daily_Cases'] = self.dt[current, (self.days[current] - 1) % self.window]
+        return stats.sort_index()
+    
+    def save(self, path):
+        np.savez_compressed(path, locations=self.locations.to_numpy(dtype=str), days=self.days,
+                            last_value=self.last_value, last_seen=self.last_seen,
+                            diffs=self.diffs, pct=self.pct, dt=self.dt, dt2=self.dt2,
+                            last_date=np.datetime64(self.last_date, 'ns'),
+                            settings=np.array([self.column, self.case_type, self.window, self.diff_window], dtype=str))
+    
+    @classmethod
+    def load(cls, path):
+        saved = np.load(path)
+        column, case_type, window, diff_window = saved['settings']
+        updater = cls(saved['locations'], column, case_type, int(window), int(diff_window))
+        for name in ['days', 'last_value', 'last_seen', 'diffs', 'pct', 'dt', 'dt2']:
+            setattr(updater, name, saved[name])
+        updater.last_date = pd.Timestamp(saved['last_date'].item())
+        return updater
+
+
+# +
+# Check the updater against the full calculation, by building it from everything but the last day and then
+# applying the last day as an update.
+stage('trend updater', rows=len(us_counties_data))
+county_last_date = us_counties_data['Date'].max()
+county_trend_updater = RecentTrendsUpdater.from_dataset(us_counties_data.loc[us_counties_data['Date'] < county_last_date],
+                                                        'County_and_State')
+county_trend_updater.update(us_counties_data.loc[us_counties_data['Date'] == county_last_date])
+
+updater_trends = format_recent_trends(county_trend_updater.stats())
+full_trends = calculate_recent_trends(us_counties_data, ['County_and_State'], tail_only=True)
+print("Updater matches the full calculation:", updater_trends.equals(full_trends.loc[updater_trends.index]))
+
+# Set this to save the updater's state, so tomorrow's run can load it and apply just the new day.
+county_trends_state_file = None
+
+if county_trends_state_file is not None:
+    county_trend_updater.save(county_trends_state_file)
+
+# ### County geometry
+# The county polygons are built by `covid-county-geometry.py` from the Census Bureau's 2016 county boundaries, at a
+# few zoom levels. The full resolution polygons are far more detail than a country wide map needs, so the national
+# and state levels are simplified (with the shared borders kept lined up between neighbors). Those two are checked in
+# under `county_geometry/`, so the map doesn't need to download anything. The full level is several times bigger, so
+# it has to be built with `python covid-county-geometry.py --zoom full` before it can be used.
+
+# +
+import gzip
+import base64
+
+county_geometry_dir = 'county_geometry'
+county_zoom_levels = ['national', 'state', 'full']
+county_map_zoom = 'national'
+
+def county_geometry(zoom=None, ids=None):
+    """County geojson at the given zoom level (county_map_zoom by default), optionally only with the features in ids."""
+    if zoom is None:
+        zoom = county_map_zoom
+    if zoom not in county_zoom_levels:
+        raise ValueError("Unknown zoom level {!r}, it should be one of {}".format(zoom, county_zoom_levels))
+    path = os.path.join(county_geometry_dir, 'counties-{}.json.gz'.format(zoom))
+    if not os.path.exists(path):
+        raise FileNotFoundError("{} is missing, build it with: python covid-county-geometry.py --zoom {}".format(path, zoom))
+    with gzip.open(path, 'rt') as f:
+        geojson = json.load(f)
+    
+    if ids is not None:
+        ids = set(ids)
+        geojson = dict(geojson, features=[feature for feature in geojson['features'] if feature['id'] in ids])
+    return geojson
+
+def typed_array(values):
+    """values as a plotly.js typed array (float32, base64 encoded), or None if they aren't numeric."""
+    values = np.asarray(values)
+    if values.dtype.kind not in 'iuf' or values.ndim == 0:
+        return None # Dates, labels, or lists with None in them stay as they are.
+    values = np.ascontiguousarray(values, dtype='<f4')
+    return {'dtype': 'f4', 'bdata': base64.b64encode(values.tobytes()).decode('ascii'),
+            'shape': ','.join(str(n) for n in values.shape)}
+
+def write_compact_figure(fig, path, attrs=('z', 'x', 'y', 'lat', 'lon')):
+    """Write fig to a gzipped JSON file with its numeric arrays stored as float32 binary blocks.
+    
+    The arrays are encoded as typed arrays here rather than relying on plotly doing it, since only plotly 6 and
+    up does that by itself. The layout's template is left out as well, it's the default one and is bigger than
+    the rest of the layout. plotly fills it back in when the file is loaded with read_compact_figure.
+    """
+    payload = fig.to_dict()
+    payload['layout'].pop('template', None)
+    for trace in payload['data']:
+        for attr in attrs:
+            if attr in trace:
+                encoded = typed_array(trace[attr])
+                if encoded is not None:
+                    trace[attr] = encoded
+    
+    with gzip.open(path, 'wt') as f:
+        json.dump(payload, f, separators=(',', ':'), cls=py.utils.PlotlyJSONEncoder)
+
+def read_compact_figure(path):
+    """Load a figure written by write_compact_figure, with the typed arrays decoded back to numpy arrays."""
+    with gzip.open(path, 'rt') as f:
+        payload = json.load(f)
+    for trace in payload['data']:
+        for attr, value in trace.items():
+            if isinstance(value, dict) and 'bdata' in value:
+                shape = [int(n) for n in value['shape'].split(',')]
+                trace[attr] = np.frombuffer(base64.b64decode(value['bdata']), dtype='<' + value['dtype']).reshape(shape)
+    return go.Figure(payload)
+
+# Set this to write the county map to a compact file that can be loaded back with read_compact_figure.
+compact_county_map_file = None
+
+stage('figure build')
+counties = county_geometry(ids=county_recent_trends['FIPS'].astype(str))
+# -
 
 # + _kg_hide-input=true _kg_hide-output=true
 #import plotly.express as px
@@ -324,7 +924,7 @@ with urlopen('https://raw.githubusercontent.com/plotly/datasets/master/geojson-c
 #))
 
 #fig.update_layout(
-#    title_text = 'Recent Trends for the last 14 days, as of ' + us_counties_data['Date'].max()+'. <br>Counties are colored by the percentage of the last 14 days that case growth has slowed.',
+#    title_text = 'Recent Trends for the last 14 days, as of ' + us_counties_data['Date'].max().strftime('%Y-%m-%d')+'. <br>Counties are colored by the percentage of the last 14 days that case growth has slowed.',
 #    #geo_scope='usa', # limit map scope to USA
 #)
 #fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
@@ -335,17 +935,17 @@ with urlopen('https://raw.githubusercontent.com/plotly/datasets/master/geojson-c
 county_recent_trends['Location']=county_recent_trends.index
 
 
-county_recent_trends['text'] = county_recent_trends['Location'] + '</br>' + \
-                        'Total Confirmed Cases: ' + county_recent_trends['Latest_Case_totals'] + '</br>' + \
-                        'New Daily Cases: ' + county_recent_trends['New_Daily_Cases'] + '</br>' + \
-                        'Case Growth Rate: ' + county_recent_trends['Case_growth'] + '</br>' + \
-                        'Average Case Acceleration: ' + county_recent_trends['Avg_Case_acceleration']
+county_recent_trends['text'] = build_hover_text(county_recent_trends, [('', 'Location'),
+                                                                       ('Total Confirmed Cases: ', 'Latest_Case_totals'),
+                                                                       ('New Daily Cases: ', 'New_Daily_Cases'),
+                                                                       ('Case Growth Rate: ', 'Case_growth'),
+                                                                       ('Average Case Acceleration: ', 'Avg_Case_acceleration')])
 
 fig_test = go.Figure(data=go.Choroplethmapbox(
     geojson=counties, # Spatial coordinate
-    locations = county_recent_trends['FIPS'],
+    locations = county_recent_trends['FIPS'].astype(str),
     text = county_recent_trends['text'],
-    z = county_recent_trends['Case_deceleration'], # Data to be color-coded
+    z = pd.to_numeric(county_recent_trends['Case_deceleration']), # Data to be color-coded
     colorscale = 'RdYlGn',
     colorbar_title = "% Deceleration Rate",
     zmin = 0,
@@ -353,12 +953,15 @@ fig_test = go.Figure(data=go.Choroplethmapbox(
 ))
 
 fig_test.update_layout(
-    title_text = 'Recent Trends for the last 14 days, as of ' + us_counties_data['Date'].max()+'. <br>Counties are colored by the percentage of the last 14 days that case growth has slowed.',
+    title_text = 'Recent Trends for the last 14 days, as of ' + us_counties_data['Date'].max().strftime('%Y-%m-%d')+'. <br>Counties are colored by the percentage of the last 14 days that case growth has slowed.',
     #geo_scope='usa', # limit map scope to USA
 )
 fig_test.update_layout(mapbox_style="carto-positron")
 fig_test.update_layout(margin={"r":10,"t":30,"l":10,"b":10})
 
+if compact_county_map_file is not None:
+    write_compact_figure(fig_test, compact_county_map_file)
+
 fig_test.show()
 # -
 
@@ -369,7 +972,8 @@ fig_test.show()
 # $^*$ Note: In physics the position and velocity are usually changed to the generalized coordinates $q$ and $\dot{q}$. This allows for a broader use of coordinates as $q$ can represent any standard cartesian cordinate ($x,y,z$), radial coordinates ($r, \theta$), or in this particular situation, total cases and new daily cases.
 
 # + _kg_hide-input=true
-us_totals = state_grp.groupby('Date', as_index=False)['Confirmed', 'Confirmed_dt', 'Confirmed_dt2'].sum()
+stage('figure build')
+us_totals = state_grp.groupby('Date', as_index=False)[['Confirmed', 'Confirmed_dt', 'Confirmed_dt2']].sum()
 
 plt_data_us = dict(data=[], layout=dict(
     title='US Only, Cases vs Daily Differential (1st derivative)',
@@ -391,6 +995,7 @@ iplot(plt_data_us)
 
 # ## Heatmaps
 
+stage('heatmaps')
 us_confirmed_subset = us_confirmed.tail(60)[us_confirmed.tail(60) > 200].dropna(axis=1).T
 
 # +
@@ -423,11 +1028,79 @@ def create_dropdown_button(name, new_title, tf_position_list):
                     {'title': new_title,
                     'showlegend': True}])
 
+# 'webgl' draws the comparison plots with Scattergl, which stays responsive with dozens (or thousands) of traces.
+# 'svg' uses the regular Scatter.
+comparison_render_mode = 'webgl'
+
+# On the log-log plots, points that land within this distance (in powers of 10) of the point before them are
+# dropped since they'd be drawn on top of each other anyway. Set to 0 to draw every point.
+loglog_min_spacing = 0.01
+
+def decimate_loglog(x, y, min_spacing=None):
+    """Mask of the points worth drawing on a log-log plot.
+    
+    Points are snapped to a grid of min_spacing in log10 space, and each run of consecutive points in the same
+    grid cell is reduced to its first point. The last point is always kept, and so is anything that can't be
+    shown on a log axis (zero, negative, NaN) so gaps in the lines stay where they were. min_spacing defaults
+    to loglog_min_spacing as it is when the function is called, so changing the setting takes effect.
+    """
+    if min_spacing is None:
+        min_spacing = loglog_min_spacing
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    keep = np.ones(len(x), dtype=bool)
+    if min_spacing <= 0 or len(x) < 3:
+        return keep
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cell_x = np.floor(np.log10(np.where(x > 0, x, np.nan)) / min_spacing)
+        cell_y = np.floor(np.log10(np.where(y > 0, y, np.nan)) / min_spacing)
+    
+    # NaN != NaN, so points that can't be drawn always count as a new cell.
+    keep[1:] = (cell_x[1:] != cell_x[:-1]) | (cell_y[1:] != cell_y[:-1])
+    keep[-1] = True
+    return keep
+
+def comparison_plot(grouped, x_col, y_col, title, xaxis, yaxis, loglog=True):
+    """Plot of y_col vs x_col with one trace per group, and a drop down to show all of them or just one.
+    
+    title is used for the 'All' view, and '<group> Only, ...' for the single group views.
+    """
+    Scatter = go.Scattergl if comparison_render_mode == 'webgl' else go.Scatter
+    
+    plt_data = dict(data=[], layout=dict(title=title, xaxis=xaxis, yaxis=yaxis))
+    
+    groups = list(grouped)
+    names = [name for name, _ in groups]
+    # Row i is the visibility list for showing just group i.
+    visible = np.eye(len(names), dtype=bool)
+    subtitle = title.split(', ', 1)[-1]
+    
+    all_buttons = [create_dropdown_button('All', title, [True] * len(names))]
+    
+    for i, (name, data) in enumerate(groups):
+        if loglog:
+            data = data.loc[decimate_loglog(data[x_col], data[y_col])]
+        plt_data['data'].append(Scatter(
+            x = data[x_col],
+            y = data[y_col],
+            mode = 'lines+markers',
+            name = name,
+            text = data.Date) )
+        all_buttons.append(create_dropdown_button(name, name+' Only, '+subtitle, visible[i].tolist()))
+    
+    plt_data['layout']['updatemenus'] = [go.layout.Updatemenu(
+        active=0,
+        buttons= all_buttons
+        )]
+    
+    return plt_data
+
 
 
 # + _kg_hide-input=true
 #fig, ax = plt.subplots(figsize=(20,20))
-#for state, data in state_grp.groupby('Province/State'):
+#for state, data in state_grp.groupby('Province/State', observed=True):
 #    plt.plot(data['Confirmed'],data['Confirmed_dt'],label=state)
 
 #ax.set_xlabel('Confirmed Cases')
@@ -441,61 +1114,24 @@ def create_dropdown_button(name, new_title, tf_position_list):
 #plt.show()
 
 # + _kg_hide-input=true
-state_grps = state_grp.groupby('Province/State')
-
-plt_data = dict(data=[], layout=dict(
-    title='State Comparison, Cases vs Daily Differential (1st derivative)',
-    #width=1500,
-    #height=1500,
-    xaxis=dict(title='Confirmed Cases',type='log'),
-    yaxis=dict(title='Daily Difference of Confirmed Cases', type='log')
-))
-
-all_buttons = list([ create_dropdown_button('All', 'State Comparison, Cases vs Daily Differential (1st derivative)', [True for x in state_grps.groups.keys()]) ])
-
-for state, state_data in state_grps:
-    plt_data['data'].append(go.Scatter(
-        x = state_data.Confirmed,
-        y = state_data.Confirmed_dt,
-        mode = 'lines+markers',
-        name = state,
-        text = state_data.Date) )
-    all_buttons.append(create_dropdown_button(state, state+' Only, Cases vs Daily Differential (1st derivative)', [x == state for x in state_grps.groups.keys()] ) )
-    
-plt_data['layout']['updatemenus'] = [go.layout.Updatemenu(
-    active=0,
-    buttons= all_buttons
-    )]
+stage('comparison plots')
+# The latest point has to survive even when it's still in the same grid cell as the points before it.
+print("decimate_loglog keeps the last point:",
+      decimate_loglog([100, 100.1, 100.2, 100.3], [10] * 4).tolist() == [True, False, False, True])
+
+plt_data = comparison_plot(state_grp.groupby('Province/State', observed=True), 'Confirmed', 'Confirmed_dt',
+                           'State Comparison, Cases vs Daily Differential (1st derivative)',
+                           xaxis=dict(title='Confirmed Cases',type='log'),
+                           yaxis=dict(title='Daily Difference of Confirmed Cases', type='log'))
     
 iplot(plt_data)
 
 
 # + _kg_hide-input=true
-state_grps = state_grp.groupby('Province/State')
-
-plt_data = dict(data=[], layout=dict(
-    title='State Comparison, Fatalities vs Daily Differential (1st derivative)',
-    #width=1500,
-    #height=1500,
-    xaxis=dict(title='Fatalities',type='log'),
-    yaxis=dict(title='Daily Difference of Fatalities', type='log')
-))
-
-all_buttons = list([ create_dropdown_button('All', 'State Comparison, Fatalities vs Daily Differential (1st derivative)', [True for x in state_grps.groups.keys()]) ])
-
-for state, state_data in state_grp.groupby('Province/State'):
-    plt_data['data'].append(go.Scatter(
-        x = state_data.Deaths,
-        y = state_data.Deaths_dt,
-        mode = 'lines+markers',
-        name = state,
-        text = state_data.Date) )
-    all_buttons.append(create_dropdown_button(state, state+' Only, Fatalities vs Daily Differential (1st derivative)', [x == state for x in state_grps.groups.keys()] ) )
-
-plt_data['layout']['updatemenus'] = [go.layout.Updatemenu(
-    active=0,
-    buttons= all_buttons
-    )]
+plt_data = comparison_plot(state_grp.groupby('Province/State', observed=True), 'Deaths', 'Deaths_dt',
+                           'State Comparison, Fatalities vs Daily Differential (1st derivative)',
+                           xaxis=dict(title='Fatalities',type='log'),
+                           yaxis=dict(title='Daily Difference of Fatalities', type='log'))
     
 iplot(plt_data)
 # -
@@ -515,6 +1151,7 @@ iplot(plt_data)
 # This is sort of a playground of ideas for me to try things that may or may not be useful.
 
 # +
+stage('sandbox')
 Benford = pd.DataFrame()
 Benford['Confirmed'] = us_counties_data.Confirmed.astype(str).str[0].astype(int).value_counts()
 Benford['Base'] = [30.1, 17.6, 12.5, 9.7, 7.9, 6.7, 5.8, 5.1, 4.6]
@@ -526,7 +1163,7 @@ Benford.plot()
 state_grp.head(20)
 
 # + _kg_hide-input=false _kg_hide-output=false
-state_grps = state_grp.groupby('Province/State')
+state_grps = state_grp.groupby('Province/State', observed=True)
 
 states = ('New York', 'Alaska', 'New Mexico', 'Washington', 'Texas')
 pops = (19.45e6, 731545, 2.097e6, 7.615e6, 29e6)
@@ -581,34 +1218,96 @@ for state, pop  in zip(states,pops):
 iplot(plt_data_2nd)
 
 # +
-state_grps = state_grp.groupby('Province/State')
+plt_data = comparison_plot(state_grp.groupby('Province/State', observed=True), 'Confirmed_dt', 'Confirmed_dt2',
+                           'State Comparison, Daily Differential vs 2nd Daily Differential',
+                           xaxis=dict(title='Confirmed Case Daily Diff'),
+                           yaxis=dict(title='Confirmed Cases 2nd Daily Differential'),
+                           loglog=False)
+    
+iplot(plt_data)
+# -
 
-plt_data = dict(data=[], layout=dict(
-    title='State Comparison, Daily Differential vs 2nd Daily Differential',
-    #width=1500,
-    #height=1500,
-    xaxis=dict(title='Confirmed Case Daily Diff'),
-    yaxis=dict(title='Confirmed Cases 2nd Daily Differential')
-))
+# state_grp.groupby('Province/State').plot('Confirmed', 'Confirmed_dt')
 
-all_buttons = list([ create_dropdown_button('All', 'State Comparison, Daily Differential vs 2nd Daily Differential', [True for x in state_grps.groups.keys()]) ])
+# ## Benchmarks
+# How much the data cleaning and trend calculations gained: the state name lookup against the old loop, the
+# rolling window functions against groupby/apply, and the memory of the county data with and without proper
+# dtypes. Set `run_benchmarks` at the top to run them, the rest of the notebook doesn't depend on them.
 
-for state, state_data in state_grp.groupby('Province/State'):
-    plt_data['data'].append(go.Scatter(
-        x = state_data.Confirmed_dt,
-        y = state_data.Confirmed_dt2,
-        mode = 'lines+markers',
-        name = state,
-        text = state_data.Date) )
-    all_buttons.append(create_dropdown_button(state, state+' Only, Daily Differential vs 2nd Daily Differential', [x == state for x in state_grps.groups.keys()] ) )
+# +
+# State name normalization, on a few million rows sampled from the raw U.S. Province/State values.
+stage('benchmarks')
+if run_benchmarks:
+    raw_provinces = all_covid.loc[all_covid['Country/Region'] == 'US', 'Province/State'].dropna()
+    raw_provinces = raw_provinces.loc[~raw_provinces.isin(['US', 'Recovered']) & ~raw_provinces.str.contains('Princess')]
+    bench_states = pd.DataFrame({'Country/Region': 'US',
+                                 'Province/State': raw_provinces.sample(5_000_000, replace=True, random_state=0).values})
+    
+    start = time.perf_counter()
+    normalized = normalize_state_names(bench_states['Province/State'], state_abbrv)
+    vectorized_time = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    normalize_state_names_loop(bench_states, state_abbrv)
+    loop_time = time.perf_counter() - start
+    
+    print("Rows: {:,}  loop: {:.2f} s  lookup: {:.2f} s  speedup: {:.1f}x  identical: {}".format(
+        len(bench_states), loop_time, vectorized_time, loop_time / vectorized_time,
+        normalized.equals(bench_states['Province/State'])))
 
-plt_data['layout']['updatemenus'] = [go.layout.Updatemenu(
-    active=0,
-    buttons= all_buttons
-    )]
+# +
+# Rolling functions vs. groupby/apply, at roughly county scale.
+if run_benchmarks:
+    n_groups, n_days = 3200, 300
+    rng = np.random.default_rng(0)
+    bench_rolling = pd.DataFrame({'County_and_State': np.repeat(np.arange(n_groups), n_days),
+                                  'Confirmed_dt2': rng.normal(size=n_groups * n_days)})
+    bench_groups = bench_rolling.groupby('County_and_State')['Confirmed_dt2']
     
-iplot(plt_data)
-# -
+    start = time.perf_counter()
+    neg_apply = bench_groups.transform(lambda x: (x < 0).rolling(14).sum())
+    mean_apply = bench_groups.transform(lambda x: x.rolling(14).mean())
+    median_apply = bench_groups.transform(lambda x: x.rolling(14).median())
+    apply_time = time.perf_counter() - start
+    
+    values = bench_rolling['Confirmed_dt2'].to_numpy()
+    
+    # Run once first so numba's compile time isn't counted.
+    for rolling_func in (rolling_mean, rolling_median, rolling_count):
+        rolling_func(values[:100], np.array([0, 100]), 14)
+    
+    start = time.perf_counter()
+    offsets = group_offsets(bench_rolling['County_and_State'])
+    neg_kernel = rolling_count(values < 0, offsets, 14)
+    mean_kernel = rolling_mean(values, offsets, 14)
+    median_kernel = rolling_median(values, offsets, 14)
+    kernel_time = time.perf_counter() - start
+    
+    same = all(np.allclose(a.to_numpy(dtype=np.float64), b, equal_nan=True)
+               for a, b in [(neg_apply, neg_kernel), (mean_apply, mean_kernel), (median_apply, median_kernel)])
+    print("Rows: {:,}  groupby/apply: {:.2f} s  rolling functions ({}): {:.2f} s  speedup: {:.1f}x  match: {}".format(
+        len(bench_rolling), apply_time, 'numba' if numba is not None else 'numpy', kernel_time,
+        apply_time / kernel_time, same))
 
-# state_grp.groupby('Province/State').plot('Confirmed', 'Confirmed_dt')
+# +
+# Memory use of the county data loaded the old way (everything as strings) vs. load_us_counties.
+if run_benchmarks:
+    old_counties = pd.read_csv(us_counties_path, dtype={'fips': object})
+    old_counties['County_and_State'] = old_counties['county'] + ', ' + old_counties['state']
+    
+    new_counties = load_us_counties(us_counties_path)
+    new_counties['County_and_State'] = combine_categories(new_counties['county'], new_counties['state'])
+    
+    old_mem = old_counties.memory_usage(deep=True) / 2**20
+    new_mem = new_counties.memory_usage(deep=True).rename(index=dict(zip(new_counties.columns, old_counties.columns))) / 2**20
+    print(pd.DataFrame({'Strings (MB)': old_mem, 'Typed (MB)': new_mem}).round(1))
+    print("Total: {:.1f} MB -> {:.1f} MB ({:.1f}x smaller)".format(old_mem.sum(), new_mem.sum(), old_mem.sum() / new_mem.sum()))
+    
+    del old_counties, new_counties
 
+# +
+profiler.finish()
+profile_output = os.environ.get('COVID_PROFILE_OUTPUT')
+if profiler.enabled and profile_output:
+    profiler.to_json(profile_output + '.json')
+    profiler.to_chrome_trace(profile_output + '.trace.json')
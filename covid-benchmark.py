@@ -0,0 +1,308 @@
+# ---
+# jupyter:
+#   jupytext:
+#     text_representation:
+#       extension: .py
+#       format_name: light
+#       format_version: '1.5'
+#       jupytext_version: 1.9.1
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# # COVID Analysis Benchmark
+# The state and territory analysis reads fixed Kaggle input files, which makes it hard to tell whether a change
+# made it faster or slower (or how it copes with more data). This generates synthetic versions of
+# `covid-19-all.csv` and `us-counties.csv` at whatever scale I want, runs the analysis notebook against them, and
+# times each stage of it: load, clean, state pivot, rolling features, recent trends and figure build.
+#
+# The notebook marks its own stages with `stage()` calls to its `StageProfiler`, which this turns on. Every stage
+# gets its wall time, CPU time, peak traced memory and number of input rows, and the results are written to a JSON
+# report so runs of two versions of the notebook can be compared.
+#
+# Usage:
+#
+#     python covid-benchmark.py --states 56 --counties 60 --days 300 --output report.json
+#     python covid-benchmark.py --compare old-report.json new-report.json
+
+# +
+import argparse
+import gzip
+import json
+import os
+import platform
+import resource
+import runpy
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+analysis_notebook = 'covid-19-u-s-state-and-territory-analysis.py'
+
+# State names and abbreviations, the abbreviations get used for the early "County, ST" style rows in covid-19-all.
+us_states = {"AL": "Alabama", "AK": "Alaska", "AZ": "Arizona", "AR": "Arkansas", "CA": "California", "CO": "Colorado",
+             "CT": "Connecticut", "DC": "District of Columbia", "DE": "Delaware", "FL": "Florida", "GA": "Georgia",
+             "HI": "Hawaii", "ID": "Idaho", "IL": "Illinois", "IN": "Indiana", "IA": "Iowa", "KS": "Kansas",
+             "KY": "Kentucky", "LA": "Louisiana", "ME": "Maine", "MD": "Maryland", "MA": "Massachusetts",
+             "MI": "Michigan", "MN": "Minnesota", "MS": "Mississippi", "MO": "Missouri", "MT": "Montana",
+             "NE": "Nebraska", "NV": "Nevada", "NH": "New Hampshire", "NJ": "New Jersey", "NM": "New Mexico",
+             "NY": "New York", "NC": "North Carolina", "ND": "North Dakota", "OH": "Ohio", "OK": "Oklahoma",
+             "OR": "Oregon", "PA": "Pennsylvania", "RI": "Rhode Island", "SC": "South Carolina", "SD": "South Dakota",
+             "TN": "Tennessee", "TX": "Texas", "UT": "Utah", "VT": "Vermont", "VA": "Virginia", "WA": "Washington",
+             "WV": "West Virginia", "WI": "Wisconsin", "WY": "Wyoming", "PR": "Puerto Rico", "GU": "Guam",
+             "VI": "Virgin Islands", "MP": "Northern Mariana Islands", "AS": "American Samoa"}
+
+# The sandbox section of the notebook looks these up by name, so they always get generated.
+required_states = ['New York', 'Alaska', 'New Mexico', 'Washington', 'Texas']
+
+
+# -
+
+# ## Synthetic data
+
+# +
+def epidemic_curves(rng, n, n_days, scale):
+    """Cumulative counts for n locations over n_days.
+
+    Each location gets a logistic wave of random size, timing and growth rate with Poisson noise on the daily
+    counts, plus the occasional downward correction like the real data has.
+    """
+    t = np.arange(n_days)
+    size = scale * rng.lognormal(0, 1, (n, 1))
+    midpoint = rng.uniform(0.2, 0.8, (n, 1)) * n_days
+    rate = rng.uniform(0.03, 0.15, (n, 1))
+
+    expected = size / (1 + np.exp(-rate * (t - midpoint)))
+    daily = rng.poisson(np.diff(expected, axis=1, prepend=0).clip(0))
+
+    corrections = (rng.random(daily.shape) < 0.002) * rng.integers(0, 20, daily.shape)
+    return np.maximum(np.cumsum(daily, axis=1) - corrections, 0)
+
+def generate_synthetic_inputs(input_dir, n_states=56, counties_per_state=60, n_days=300, seed=0):
+    """Write synthetic covid-19-all.csv and us-counties.csv into input_dir, in the Kaggle input layout.
+
+    Returns the number of rows in each file.
+    """
+    rng = np.random.default_rng(seed)
+
+    abbrvs = [abbrv for abbrv, name in us_states.items() if name in required_states]
+    abbrvs += [abbrv for abbrv, name in us_states.items() if name not in required_states]
+    abbrvs = abbrvs[:n_states]
+    # Past the real ones, the extra states just get made up names.
+    abbrvs += ['X{}'.format(i) for i in range(n_states - len(abbrvs))]
+    states = np.array([us_states.get(abbrv, 'State ' + abbrv) for abbrv in abbrvs], dtype=object)
+    dates = pd.date_range('2020-01-21', periods=n_days)
+    date_strs = np.array(dates.strftime('%Y-%m-%d'), dtype=object)
+
+    # County level data, each state also gets an "Unknown" county with no FIPS code like the NYT data.
+    n_counties = counties_per_state + 1
+    cases = epidemic_curves(rng, n_states * n_counties, n_days, scale=2000)
+    lag = 14
+    cfr = rng.uniform(0.005, 0.03, (n_states * n_counties, 1))
+    deaths = np.floor(np.concatenate([np.zeros((len(cases), lag)), cases[:, :-lag]], axis=1) * cfr).astype(np.int64)
+
+    # Counties only show up in the NYT data from their first case on.
+    county_idx, day_idx = np.nonzero(cases > 0)
+    state_idx = county_idx // n_counties
+    county_num = county_idx % n_counties
+    county_names = np.array(['County {:03d}'.format(i + 1) for i in range(counties_per_state)] + ['Unknown'], dtype=object)
+    fips = np.array(['{:02d}{:03d}'.format(s + 1, c + 1) for s in range(n_states) for c in range(counties_per_state)]
+                    + [''], dtype=object)
+    fips_idx = np.where(county_num < counties_per_state, state_idx * counties_per_state + county_num, len(fips) - 1)
+
+    us_counties = pd.DataFrame({'date': date_strs[day_idx],
+                                'county': county_names[county_num],
+                                'state': states[state_idx],
+                                'fips': fips[fips_idx],
+                                'cases': cases[county_idx, day_idx],
+                                'deaths': deaths[county_idx, day_idx]})
+    us_counties = us_counties.sort_values(['date', 'state', 'county'], kind='stable')
+
+    # State level data for covid-19-all.csv, from the county totals.
+    state_cases = cases.reshape(n_states, n_counties, n_days).sum(axis=1)
+    state_deaths = deaths.reshape(n_states, n_counties, n_days).sum(axis=1)
+    state_recovered = np.floor(np.concatenate([np.zeros((n_states, 21)), state_cases[:, :-21]], axis=1) * 0.6)
+
+    s_idx, d_idx = np.nonzero(state_cases > 0)
+    provinces = states[s_idx].copy()
+    # For the first few weeks the real data was reported by county ("King County, WA"), and Chicago on its own.
+    early = d_idx < 30
+    provinces[early] = ['Some County, ' + abbrvs[s] for s in s_idx[early]]
+    provinces[early & (provinces == 'Some County, IL')] = 'Chicago'
+
+    us_rows = pd.DataFrame({'Country/Region': 'US',
+                            'Province/State': provinces,
+                            'Latitude': rng.uniform(20, 60, len(s_idx)),
+                            'Longitude': rng.uniform(-160, -65, len(s_idx)),
+                            'Confirmed': state_cases[s_idx, d_idx],
+                            'Recovered': state_recovered[s_idx, d_idx],
+                            'Deaths': state_deaths[s_idx, d_idx],
+                            'Date': date_strs[d_idx]})
+
+    # The odd rows the notebook has to drop, plus a few other countries.
+    extras = []
+    for province in ['Diamond Princess', 'Grand Princess', 'Recovered', 'US']:
+        extras.append(pd.DataFrame({'Country/Region': 'US', 'Province/State': province,
+                                    'Confirmed': rng.integers(0, 1000, n_days), 'Recovered': 0, 'Deaths': 0,
+                                    'Date': date_strs}))
+    for country in ['Canada', 'Italy', 'Japan', 'Brazil']:
+        extras.append(pd.DataFrame({'Country/Region': country, 'Province/State': np.nan,
+                                    'Confirmed': epidemic_curves(rng, 1, n_days, 50000)[0], 'Recovered': 0,
+                                    'Deaths': 0, 'Date': date_strs}))
+    all_covid = pd.concat([us_rows] + extras, ignore_index=True, sort=False).sort_values('Date', kind='stable')
+    all_covid = all_covid[['Country/Region', 'Province/State', 'Latitude', 'Longitude', 'Confirmed', 'Recovered',
+                           'Deaths', 'Date']]
+
+    os.makedirs(os.path.join(input_dir, 'coronavirus-2019ncov'), exist_ok=True)
+    os.makedirs(os.path.join(input_dir, 'us-counties-covid-19-dataset'), exist_ok=True)
+    all_covid.to_csv(os.path.join(input_dir, 'coronavirus-2019ncov', 'covid-19-all.csv'), index=False)
+    us_counties.to_csv(os.path.join(input_dir, 'us-counties-covid-19-dataset', 'us-counties.csv'), index=False)
+
+    return {'covid-19-all': len(all_covid), 'us-counties': len(us_counties)}
+
+def generate_county_geojson(path, fips, points_per_side=25):
+    """Square county polygons laid out on a grid, written gzipped like the county geometry the notebook loads.
+
+    The synthetic FIPS codes don't match real counties, so these stand in for the real polygons.
+    """
+    features = []
+    side = np.linspace(0, 0.5, points_per_side, endpoint=False)
+    for i, code in enumerate(fips):
+        x0, y0 = -125 + (i % 120) * 0.5, 25 + (i // 120) * 0.5
+        ring = ([[x0 + d, y0] for d in side] + [[x0 + 0.5, y0 + d] for d in side] +
+                [[x0 + 0.5 - d, y0 + 0.5] for d in side] + [[x0, y0 + 0.5 - d] for d in side] + [[x0, y0]])
+        features.append({'type': 'Feature', 'id': code, 'properties': {},
+                         'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, 'wt') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+
+# -
+
+# ## Stage timing
+
+# +
+def run_notebook(notebook, input_dir, work_dir, track_memory=True):
+    """Run the analysis notebook against the data in input_dir with its StageProfiler on, from inside work_dir.
+
+    Returns the notebook's profiler.
+    """
+    # Nothing gets displayed, the figures are still built.
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    import plotly.io as pio
+    import plotly.offline
+    pio.show = lambda *args, **kwargs: None
+    plotly.offline.iplot = lambda *args, **kwargs: None
+    plotly.offline.init_notebook_mode = lambda *args, **kwargs: None
+
+    os.environ['COVID_INPUT_DIR'] = input_dir
+    os.environ['COVID_PROFILE'] = '1'
+    os.environ['COVID_PROFILE_MEMORY'] = '1' if track_memory else '0'
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        notebook_globals = runpy.run_path(notebook)
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        os.chdir(cwd)
+        plt.close('all')
+
+    return notebook_globals['profiler']
+
+def run_benchmark(n_states=56, counties_per_state=60, n_days=300, seed=0, notebook=analysis_notebook,
+                  track_memory=True):
+    """Generate the synthetic data, run the notebook against it and return the report."""
+    notebook = os.path.abspath(notebook)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_dir = os.path.join(work_dir, 'input')
+        start = time.perf_counter()
+        input_rows = generate_synthetic_inputs(input_dir, n_states, counties_per_state, n_days, seed)
+        generate_time = time.perf_counter() - start
+
+        fips = pd.read_csv(os.path.join(input_dir, 'us-counties-covid-19-dataset', 'us-counties.csv'),
+                           usecols=['fips'], dtype=str)['fips'].dropna().unique()
+        generate_county_geojson(os.path.join(work_dir, 'county_geometry', 'counties-national.json.gz'), fips)
+
+        profiler = run_notebook(notebook, input_dir, work_dir, track_memory)
+
+    stages = profiler.summary()
+    return {'generated': datetime.now().isoformat(timespec='seconds'),
+            'notebook': os.path.basename(notebook),
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'pandas': pd.__version__, 'machine': platform.machine(),
+                            'cpus': os.cpu_count()},
+            'scale': {'states': n_states, 'counties_per_state': counties_per_state, 'days': n_days, 'seed': seed},
+            'input_rows': input_rows,
+            'generate_s': generate_time,
+            'track_memory': track_memory,
+            'stages': stages,
+            'total_wall_s': sum(stage['wall_s'] for stage in stages.values()),
+            'total_cpu_s': sum(stage['cpu_s'] for stage in stages.values()),
+            # ru_maxrss is in kilobytes on Linux
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'records': profiler.records}
+
+def print_report(report):
+    print("Scale: {states} states x {counties_per_state} counties x {days} days".format(**report['scale']))
+    print("Input rows: " + ", ".join("{}: {:,}".format(name, rows) for name, rows in report['input_rows'].items()))
+    print("{:<18} {:>6} {:>12} {:>10} {:>10} {:>10}".format('Stage', 'Calls', 'Rows', 'Wall (s)', 'CPU (s)', 'Peak (MB)'))
+    for name, stage in report['stages'].items():
+        peak = '-' if stage['peak_mb'] is None else '{:.1f}'.format(stage['peak_mb'])
+        print("{:<18} {:>6} {:>12,} {:>10.3f} {:>10.3f} {:>10}".format(name, stage['calls'], stage['rows'],
+                                                                      stage['wall_s'], stage['cpu_s'], peak))
+    print("{:<18} {:>6} {:>12} {:>10.3f} {:>10.3f}".format('Total', '', '', report['total_wall_s'], report['total_cpu_s']))
+
+def compare_reports(old, new):
+    """Print the per-stage change in wall time and peak memory between two reports."""
+    if old['scale'] != new['scale']:
+        print("Warning: the reports were run at different scales, {} vs {}".format(old['scale'], new['scale']))
+    print("{:<18} {:>10} {:>10} {:>8} {:>11} {:>11}".format('Stage', 'Old (s)', 'New (s)', 'Speedup',
+                                                           'Old (MB)', 'New (MB)'))
+    for name in list(old['stages']) + [name for name in new['stages'] if name not in old['stages']]:
+        old_stage = old['stages'].get(name, {})
+        new_stage = new['stages'].get(name, {})
+        fmt = lambda value, spec: '-' if value is None else spec.format(value)
+        old_wall, new_wall = old_stage.get('wall_s'), new_stage.get('wall_s')
+        speedup = old_wall / new_wall if old_wall and new_wall else None
+        print("{:<18} {:>10} {:>10} {:>8} {:>11} {:>11}".format(name, fmt(old_wall, '{:.3f}'), fmt(new_wall, '{:.3f}'),
+                                                               fmt(speedup, '{:.2f}x'),
+                                                               fmt(old_stage.get('peak_mb'), '{:.1f}'),
+                                                               fmt(new_stage.get('peak_mb'), '{:.1f}')))
+
+
+# -
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the COVID analysis notebook on synthetic data.")
+    parser.add_argument('--states', type=int, default=56)
+    parser.add_argument('--counties', type=int, default=60, help="Counties per state")
+    parser.add_argument('--days', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--notebook', default=analysis_notebook)
+    parser.add_argument('--no-memory', action='store_true', help="Don't track peak memory (it adds overhead)")
+    parser.add_argument('--output', default='covid-benchmark-report.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two existing reports")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            compare_reports(json.load(f_old), json.load(f_new))
+        sys.exit()
+
+    report = run_benchmark(args.states, args.counties, args.days, args.seed, args.notebook, not args.no_memory)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print_report(report)
+    print("Report written to " + args.output)
@@ -0,0 +1,219 @@
+# ---
+# jupyter:
+#   jupytext:
+#     text_representation:
+#       extension: .py
+#       format_name: light
+#       format_version: '1.5'
+#       jupytext_version: 1.9.1
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# # County Geometry
+# Builds the county polygons the state and territory analysis draws its county map with, at each of its zoom
+# levels, and writes them to `county_geometry/counties-<zoom>.json.gz`. Every level comes from the same source, the
+# Census Bureau's 2016 500k cartographic boundary file for counties, so a county has the same FIPS code (and
+# outline) at every zoom level. The 2016 file also has the post-2015 codes the NYT county data uses, e.g. 46102 for
+# Oglala Lakota County.
+#
+# The full resolution polygons are far more detail than a country wide map needs, so the national and state levels
+# are run through Douglas-Peucker. Running it on each county's rings separately would simplify the two sides of a
+# shared border differently and leave gaps and overlaps between neighbors, so the rings are first split into arcs at
+# every point where the set of counties sharing the border changes. Each arc gets simplified the same way whichever
+# county it belongs to, so the borders still line up.
+#
+# The shapefile is read with pyshp. It's taken from the plotly-geo package if that's installed (it's the file
+# plotly's own county choropleths use), otherwise it's downloaded from the Census Bureau.
+#
+# Usage:
+#
+#     python covid-county-geometry.py
+#     python covid-county-geometry.py --zoom full
+
+# +
+import argparse
+import gzip
+import json
+import os
+from collections import defaultdict
+from urllib.request import urlopen
+
+import numpy as np
+
+try:
+    import shapefile
+except ImportError:
+    shapefile = None
+
+county_shapefile_name = 'cb_2016_us_county_500k'
+county_shapefile_url = 'https://www2.census.gov/geo/tiger/GENZ2016/shp/cb_2016_us_county_500k.zip'
+county_geometry_dir = 'county_geometry'
+
+# Douglas-Peucker tolerance in degrees (0.01 is roughly 1 km) and the decimal places the coordinates are written
+# with, for each zoom level. The full level keeps every point.
+county_zoom_levels = {'national': (0.02, 3), 'state': (0.002, 4), 'full': (None, 6)}
+
+def county_shapefile(cache_dir='.'):
+    """Path of the county shapefile, from plotly-geo if it's installed or the Census Bureau if it isn't."""
+    try:
+        import _plotly_geo
+        path = os.path.join(os.path.dirname(_plotly_geo.__file__), 'package_data', county_shapefile_name)
+        if os.path.exists(path + '.shp'):
+            return path
+    except ImportError:
+        pass
+
+    path = os.path.join(cache_dir, county_shapefile_name + '.zip')
+    if not os.path.exists(path):
+        with urlopen(county_shapefile_url) as response, open(path, 'wb') as f:
+            f.write(response.read())
+    return path
+
+def read_counties(path):
+    """The counties in the shapefile as (FIPS, name, state FIPS, county FIPS, polygons) tuples, sorted by FIPS.
+
+    Each polygon is a list of closed rings, and each ring a list of (lon, lat) tuples.
+    """
+    if shapefile is None:
+        raise ImportError("Reading the county shapefile needs pyshp (pip install pyshp)")
+    counties = []
+    with shapefile.Reader(path) as reader:
+        for shape_record in reader.iterShapeRecords():
+            record = shape_record.record.as_dict()
+            geometry = shape_record.shape.__geo_interface__
+            polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+            polygons = [[[tuple(point) for point in ring] for ring in polygon] for polygon in polygons]
+            counties.append((record['GEOID'], record['NAME'], record['STATEFP'], record['COUNTYFP'], polygons))
+    return sorted(counties)
+
+def douglas_peucker(points, tolerance):
+    """Mask of the points Douglas-Peucker keeps from points (an n x 2 array), the two ends are always kept."""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, chord = points[first], points[last] - points[first]
+        offsets = points[first+1:last] - start
+        length = np.hypot(*chord)
+        if length == 0:
+            distance = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distance = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / length
+        i = int(np.argmax(distance))
+        if distance[i] > tolerance:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+def find_junctions(counties):
+    """Points the rings have to be split at so that every arc between them has the same neighbors all along it.
+
+    That's any point where the set of counties a point belongs to changes from the point before or after it. Rings
+    that don't touch any other county (islands, or counties entirely inside another) get their lowest and highest
+    points, so they're still split into two arcs in the same way as the hole they fill.
+    """
+    owners = defaultdict(set)
+    for i, (_, _, _, _, polygons) in enumerate(counties):
+        for polygon in polygons:
+            for ring in polygon:
+                for point in ring[:-1]:
+                    owners[point].add(i)
+
+    junctions = set()
+    loose_rings = []
+    for _, _, _, _, polygons in counties:
+        for polygon in polygons:
+            for ring in polygon:
+                points = ring[:-1]
+                found = False
+                for i, point in enumerate(points):
+                    if owners[point] != owners[points[i-1]] or owners[point] != owners[points[(i+1) % len(points)]]:
+                        junctions.add(point)
+                        found = True
+                if not found:
+                    loose_rings.append(points)
+
+    for points in loose_rings:
+        junctions.update([min(points), max(points)])
+    return junctions
+
+def simplify_arc(arc, tolerance):
+    # Simplified in a fixed direction, so the arc comes out the same from the county on either side of it.
+    reverse = arc[-1] < arc[0] or (arc[-1] == arc[0] and arc[-2] < arc[1])
+    points = np.array(arc[::-1] if reverse else arc)
+    points = points[douglas_peucker(points, tolerance)]
+    return points[::-1] if reverse else points
+
+def simplify_ring(ring, junctions, tolerance, decimals):
+    points = ring[:-1]
+    splits = [i for i, point in enumerate(points) if point in junctions]
+    if tolerance is not None and splits:
+        # Start the ring at a junction, then each arc runs from one junction to the next.
+        points = points[splits[0]:] + points[:splits[0]] + [points[splits[0]]]
+        splits = [i - splits[0] for i in splits] + [len(points) - 1]
+        arcs = [simplify_arc(points[start:end+1], tolerance)[:-1] for start, end in zip(splits[:-1], splits[1:])]
+        coords = np.concatenate(arcs + [np.array(points[-1:])])
+    else:
+        coords = np.array(ring)
+
+    coords = np.round(coords, decimals)
+    coords = coords[np.r_[True, np.any(coords[1:] != coords[:-1], axis=1)]]
+    # A ring needs at least 3 distinct points plus the closing one, rings smaller than the tolerance keep their
+    # original points.
+    if len(coords) < 4:
+        coords = np.round(np.array(ring), decimals)
+    return coords.tolist()
+
+def county_geojson(counties, zoom):
+    """The counties as a geojson FeatureCollection at the given zoom level, with the FIPS codes as feature ids."""
+    tolerance, decimals = county_zoom_levels[zoom]
+    junctions = find_junctions(counties) if tolerance is not None else set()
+
+    features = []
+    for fips, name, state, county, polygons in counties:
+        polygons = [[simplify_ring(ring, junctions, tolerance, decimals) for ring in polygon] for polygon in polygons]
+        geometry = ({'type': 'Polygon', 'coordinates': polygons[0]} if len(polygons) == 1 else
+                    {'type': 'MultiPolygon', 'coordinates': polygons})
+        features.append({'type': 'Feature', 'id': fips, 'properties': {'STATE': state, 'COUNTY': county, 'NAME': name},
+                         'geometry': geometry})
+    return {'type': 'FeatureCollection', 'features': features}
+
+def write_county_geometry(geojson, path):
+    # mtime=0 so rebuilding from the same source gives the same bytes.
+    with open(path, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+        f.write(json.dumps(geojson, separators=(',', ':')).encode())
+
+def count_points(geojson):
+    total = 0
+    for feature in geojson['features']:
+        geometry = feature['geometry']
+        polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        total += sum(len(ring) for polygon in polygons for ring in polygon)
+    return total
+
+
+# -
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the county geometry for the county map's zoom levels.")
+    parser.add_argument('--zoom', nargs='+', choices=list(county_zoom_levels), default=['national', 'state'])
+    parser.add_argument('--shapefile', help="County shapefile (.shp or .zip) to use instead of finding one")
+    parser.add_argument('--output-dir', default=county_geometry_dir)
+    args = parser.parse_args()
+
+    counties = read_counties(args.shapefile or county_shapefile())
+    os.makedirs(args.output_dir, exist_ok=True)
+    for zoom in args.zoom:
+        geojson = county_geojson(counties, zoom)
+        path = os.path.join(args.output_dir, 'counties-{}.json.gz'.format(zoom))
+        write_county_geometry(geojson, path)
+        print("{:<9} {:>6,} counties  {:>10,} points  {:>6.2f} MB  {}".format(
+            zoom, len(geojson['features']), count_points(geojson), os.path.getsize(path) / 2**20, path))
@@ -19,45 +19,84 @@
 
 import numpy as np # linear algebra
 import pandas as pd # data processing, CSV file I/O (e.g. pd.read_csv)
+import os
+import json
+import time
+import queue
+import hashlib
+import itertools
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 from scipy import optimize
 from sklearn.metrics import mean_absolute_error, f1_score
 from matplotlib import pyplot as plt
-from sklearn.decomposition import PCA
+from sklearn.utils.extmath import randomized_svd
 from sklearn.model_selection import train_test_split
 
 # Input data files are available in the "../input/" directory.
 # For example, running this (by clicking run or pressing Shift+Enter) will list all files under the input directory
 
 sample_submission = pd.read_csv("../input/digit-recognizer/sample_submission.csv")
-test = pd.read_csv("../input/digit-recognizer/test.csv")
-train = pd.read_csv("../input/digit-recognizer/train.csv")
+# train.csv and test.csv are loaded through the dataset cache (see load_digit_csv below).
+train_path = "../input/digit-recognizer/train.csv"
+test_path = "../input/digit-recognizer/test.csv"
 
 # Any results you write to the current directory are saved as output.
 
+# Set this to run the timing comparisons at the bottom of the notebook.
+run_benchmarks = False
+# The gradient checks at the bottom only take a few seconds.
+run_gradient_checks = True
+
+# Precision the network is trained and run in, from the SGD and CG training to the predictions. np.float32 halves
+# the memory traffic of the matrix products, the cost is still added up in float64 either way.
+compute_dtype = np.float64
+
 # + [markdown] _cell_guid="79c7e3d0-c299-4dcb-8224-4455121ee9b0" _uuid="d629ff2d2480ee46fbb7e2d37f6b5fab8052498a"
 # Next up is based on some code I'd written previously in MATLAB. While ultimately this is recreating neural network code that other libraries already implement, I'm doing this as an exercise in using numpy. 
 
 # +
-def sigmoid(z):
-    return 1 / (1 + np.exp(-z))
+def sigmoid(z, out=None):
+    """out works like it does for numpy's ufuncs, passing z as out does it in place."""
+    # exp overflowing to inf (which happens a lot sooner in float32) still gives the right answer of 0.
+    with np.errstate(over='ignore'):
+        if out is None:
+            return 1 / (1 + np.exp(-z))
+        np.negative(z, out=out)
+        np.exp(out, out=out)
+    out += 1
+    return np.reciprocal(out, out=out)
+
+def log_sigmoid(z, out=None):
+    """log(sigmoid(z)), without going through sigmoid(z) which rounds to 0 or 1 for large z and makes the log -inf
+    (in float32 that starts at about |z| > 17)."""
+    out = np.logaddexp(0, -z, out=out)
+    return np.negative(out, out=out)
 
 def sigmoidGradient(z):
     """Caclulate the gradient of the sigmoid function"""
     return sigmoid(z) * (1 - sigmoid(z))
 
-def normalize(X):
+# This is so we don't get divide by zero errors.
+# TODO: Take this out and run the data through PCA to see if that helps.
+normalize_epsilon = 1e-100
+
+def normalization_stats(X):
+    """Mean and standard deviation of each pixel/feature column, as used by normalize."""
     (m, n) = X.shape
-    
-    # This is so we don't get divide by zero errors.
-    # TODO: Take this out and run the data through PCA to see if that helps.
-    epsilon = 1e-100
-    
-    # Noramlizing each pixel/feature column
     mu = np.mean(X, axis=0).reshape(1,n)
-    X_norm = X - mu
-    sigma = np.std(X_norm, axis=0, ddof=1).reshape(1,n)
+    sigma = np.std(X - mu, axis=0, ddof=1).reshape(1,n)
+    return mu, sigma
+
+def normalize(X, mu=None, sigma=None):
+    """Normalize each pixel/feature column, with X's own mean and standard deviation unless they're given (like
+    the training set's, for the test set)."""
+    if mu is None:
+        mu, sigma = normalization_stats(X)
     
-    return X_norm/(sigma+epsilon)
+    return (X - mu)/(sigma+normalize_epsilon)
     
 
 
@@ -88,32 +127,92 @@ def NNCostFunction(nn_params, input_layer_sz, hidden_layer_sz, num_labels, X, y,
     Theta1 = nn_params[:hidden_layer_sz*(input_layer_sz+1)].reshape(hidden_layer_sz,input_layer_sz+1)
     Theta2 = nn_params[hidden_layer_sz*(input_layer_sz+1):].reshape(num_labels,hidden_layer_sz+1)
     
-    # Add bias element
-    X = np.insert(X, 0, 1, axis=1)
-    
-    # Calculate the hidden layer
-    a2 = sigmoid(X @ Theta1.T)
-    
-    # Add the bias elements
-    a2 = np.insert(a2, 0, 1, axis=1)
+    # Calculate the hidden layer, column 0 of each Theta is the bias weight.
+    a2 = sigmoid(X @ Theta1[:,1:].T + Theta1[:,0])
     
-    # Calculate the output layer.
-    h = sigmoid(a2 @ Theta2.T)
+    # Calculate the output layer. The cost only needs its log, see log_sigmoid.
+    z3 = a2 @ Theta2[:,1:].T + Theta2[:,0]
     
     # Convert y to a matrix with rows as each example (still), and columns corresponding to each output neuron. 
-    y = y.reshape(m,1) == np.arange(10)
+    y = y.reshape(m,1) == np.arange(num_labels)
     
     # Calculate the cost
     # Testing out two different ways of doing this first looping through columns
-    J = np.sum(1/m * ( -(y*np.log(h)) - (1-y) * np.log(1-h)))
+    # log(1-h) is log(sigmoid(-z3)). The sum is done in float64 whatever the precision of everything else.
+    J = -np.sum(np.where(y, log_sigmoid(z3), log_sigmoid(-z3)), dtype=np.float64) / m
     #for k in range(y.shape[1]):
     #    J = J + 1/m * (-(y[:,k] @ np.log(h[:,k])) - (1-y[:,k]) @ np.log(1-h[:,k]))
     
-    # Regularization goes here
-    #TODO: Convert Regularization from MatLab code
+    # Regularization, the bias weights aren't included.
+    J += my_lambda/(2*m) * (np.sum(Theta1[:,1:]**2) + np.sum(Theta2[:,1:]**2))
     return(J)
     
+def NNCostGradFunction(nn_params, input_layer_sz, hidden_layer_sz, num_labels, X, y, my_lambda=0 ):
+    """Calculate the cost function and its gradient together, from a single forward pass over the batch.
+    
+    Same arguments as NNCostFunction. This is what the training loop uses, and it can go straight into
+    optimize.minimize with jac=True. Each layer's deltas for every example come out of one matrix product, and
+    the bias weights are handled separately instead of inserting a column of ones into X (which copies all of it).
+    Everything is computed in X's dtype, so float32 data runs in float32, while grad keeps nn_params' dtype.
+    
+    Return Values:
+        J: Cost function
+        grad: Gradient of the Cost function, flattened the same way as nn_params
+    """
+    
+    # Initial setup of useful variables and return values.
+    (m, n) = X.shape
+    split = hidden_layer_sz*(input_layer_sz+1)
+    
+    dtype = np.result_type(X.dtype, np.float32)
+    Theta1 = nn_params[:split].reshape(hidden_layer_sz,input_layer_sz+1).astype(dtype, copy=False)
+    Theta2 = nn_params[split:].reshape(num_labels,hidden_layer_sz+1).astype(dtype, copy=False)
+    
+    # Feed forward, column 0 of each Theta is the bias weight.
+    a_2 = sigmoid(X @ Theta1[:,1:].T + Theta1[:,0])
+    z_3 = a_2 @ Theta2[:,1:].T + Theta2[:,0]
+    a_3 = sigmoid(z_3)
+    
+    # Convert y to a matrix with rows as each example (still), and columns corresponding to each output neuron.
+    y = y.reshape(m,1) == np.arange(num_labels)
+    
+    # Same cost as NNCostFunction, with only one log per element: log(h) where y is 1 and log(1-h) where it's 0.
+    # -log(sigmoid(z)) is logaddexp(0, -z) and -log(1-sigmoid(z)) is logaddexp(0, z).
+    J = np.sum(np.logaddexp(0, np.where(y, -z_3, z_3)), dtype=np.float64) / m
+    
+    # Backpropagation, rows are examples.
+    d_3 = a_3 - y
+    # The bias unit has no inputs, so its column of Theta2 doesn't feed back. a_2*(1-a_2) is sigmoidGradient(z_2).
+    d_2 = (d_3 @ Theta2[:,1:]) * a_2 * (1 - a_2)
+    
+    # Accumulate gradients straight into the flattened result, summing over the examples.
+    grad = np.empty(nn_params.shape)
+    Theta1_grad = grad[:split].reshape(Theta1.shape)
+    Theta2_grad = grad[split:].reshape(Theta2.shape)
+    
+    Theta1_grad[:,0] = d_2.sum(axis=0)
+    Theta1_grad[:,1:] = d_2.T @ X
+    Theta2_grad[:,0] = d_3.sum(axis=0)
+    Theta2_grad[:,1:] = d_3.T @ a_2
+    
+    # Average out all of the values
+    grad /= m
+    
+    # Regularization, the bias weights aren't included.
+    if my_lambda:
+        J += my_lambda/(2*m) * (np.sum(Theta1[:,1:]**2) + np.sum(Theta2[:,1:]**2))
+        Theta1_grad[:,1:] += my_lambda/m * Theta1[:,1:]
+        Theta2_grad[:,1:] += my_lambda/m * Theta2[:,1:]
+    
+    return(J, grad)
+
 def NNGradFunction(nn_params, input_layer_sz, hidden_layer_sz, num_labels, X, y, my_lambda=0 ):
+    """Calculate the gradient of NNCostFunction, for when the cost isn't needed too."""
+    return NNCostGradFunction(nn_params, input_layer_sz, hidden_layer_sz, num_labels, X, y, my_lambda)[1]
+    
+def NNGradFunction_loop(nn_params, input_layer_sz, hidden_layer_sz, num_labels, X, y, my_lambda=0 ):
+    """My original version of NNGradFunction, backpropagating one example at a time. It's kept around for the
+    benchmark at the bottom, and as a reference to check the faster versions against."""
     
     # Initial setup of useful variables and return values.
     (m, n) = X.shape
@@ -127,7 +226,7 @@ def NNGradFunction(nn_params, input_layer_sz, hidden_layer_sz, num_labels, X, y,
     # Inert bias element (1) into X before index 0
     X = np.insert(X, 0, 1, axis=1)
     # Convert y to a matrix with rows as each example (still), and columns corresponding to each output neuron. 
-    y = y.reshape(m,1) == np.arange(10)
+    y = y.reshape(m,1) == np.arange(num_labels)
     
     # Backpropagation
     # TODO: Test different types of loops to see which is faster
@@ -178,67 +277,768 @@ def NNGradFunction(nn_params, input_layer_sz, hidden_layer_sz, num_labels, X, y,
     return(grad)
 
 
+# ## Deeper networks
+# Everything above is written for exactly two layers. The functions below take a list of layer sizes instead
+# (input, any number of hidden layers, output) so the network can be made deeper or wider without rewriting
+# anything. The parameters are still one flat vector, each layer's Theta flattened one after the other in the same
+# way as nn_params, so they work with optimize.minimize too. With layer_sizes = [input_layer_sz, hidden_layer_sz,
+# num_labels] they give the same results as NNCostGradFunction.
+#
+# The hidden layers can use the sigmoid or ReLU, the output layer is always the sigmoid since the cost treats
+# each output as a probability.
+
+# +
+def relu(z, out=None):
+    return np.maximum(z, 0, out=out)
+
+# Each activation and its derivative, written in terms of the activation's output since that's what gets kept.
+layer_activations = {'sigmoid': (sigmoid, lambda a: a * (1 - a)),
+                     'relu': (relu, lambda a: (a > 0).astype(a.dtype))}
+
+def _lap(timings, key, start):
+    """Add the time since start to timings[key] if timings are being kept (it's a dict), and return the time now.
+    
+    This is how profile_layers times each layer of the real training code.
+    """
+    now = time.perf_counter()
+    if timings is not None:
+        timings.setdefault(key, []).append(now - start)
+    return now
+
+def unpack_params(nn_params, layer_sizes):
+    """Each layer's Theta (a view of nn_params), with the bias weights in column 0."""
+    Thetas = []
+    start = 0
+    for n_in, n_out in zip(layer_sizes[:-1], layer_sizes[1:]):
+        Thetas.append(nn_params[start:start + n_out*(n_in+1)].reshape(n_out, n_in+1))
+        start += n_out*(n_in+1)
+    return Thetas
+
+def init_layer_params(layer_sizes, activation='sigmoid', seed=None):
+    """Random starting weights for a network with layer_sizes, as a flat nn_params vector.
+    
+    The sigmoid layers get the same +-0.12 uniform weights as the two-layer network. ReLU layers get He
+    initialization (normal with a standard deviation of sqrt(2/inputs)), since small uniform weights make a deep
+    ReLU network's activations shrink towards 0 layer by layer. The biases start at 0.
+    """
+    rng = np.random.default_rng(seed)
+    nn_params = np.zeros(sum(n_out*(n_in+1) for n_in, n_out in zip(layer_sizes[:-1], layer_sizes[1:])))
+    Thetas = unpack_params(nn_params, layer_sizes)
+    for i, Theta in enumerate(Thetas):
+        (n_out, n_in) = (Theta.shape[0], Theta.shape[1] - 1)
+        if activation == 'relu' and i < len(Thetas) - 1:
+            Theta[:,1:] = rng.normal(0, np.sqrt(2 / n_in), (n_out, n_in))
+        else:
+            Theta[:,1:] = rng.uniform(-0.12, 0.12, (n_out, n_in))
+    return nn_params
+
+def feed_forward(Thetas, X, activation='sigmoid', timings=None):
+    """Activations of every layer, from X to the output layer's pre-activation (z, not the sigmoid of it)."""
+    act = layer_activations[activation][0]
+    layers = [X]
+    start = time.perf_counter()
+    for i, Theta in enumerate(Thetas[:-1]):
+        layers.append(act(layers[-1] @ Theta[:,1:].T + Theta[:,0]))
+        start = _lap(timings, (i, 'forward'), start)
+    layers.append(layers[-1] @ Thetas[-1][:,1:].T + Thetas[-1][:,0])
+    _lap(timings, (len(Thetas) - 1, 'forward'), start)
+    return layers
+
+def NNLayersCostGradFunction(nn_params, layer_sizes, X, y, my_lambda=0, activation='sigmoid', timings=None):
+    """Calculate the cost function and its gradient for a network with any number of layers.
+    
+    Arguments:
+        nn_params: Every layer's Theta, flattened into one vector
+        layer_sizes: Sizes of the input layer, each hidden layer and the output layer
+        X: Array of data
+        y: Array of output
+        my_lambda: Regularization parameter
+        activation: Activation for the hidden layers, 'sigmoid' or 'relu'
+        timings: Optional dict, each layer's forward and backward pass times get appended to it
+        
+    Return Values:
+        J: Cost function
+        grad: Gradient of the Cost function, flattened the same way as nn_params
+    """
+    (m, n) = X.shape
+    Thetas = unpack_params(nn_params, layer_sizes)
+    act_gradient = layer_activations[activation][1]
+    
+    layers = feed_forward(Thetas, X, activation, timings)
+    z_out = layers.pop()
+    
+    y = y.reshape(m,1) == np.arange(layer_sizes[-1])
+    # -log(h) where y is 1 and -log(1-h) where it's 0, see NNCostGradFunction
+    J = np.sum(np.logaddexp(0, np.where(y, -z_out, z_out)), dtype=np.float64) / m
+    
+    # Backpropagation, from the output layer back to the first.
+    grad = np.empty(nn_params.shape, dtype=nn_params.dtype)
+    Theta_grads = unpack_params(grad, layer_sizes)
+    start = time.perf_counter()
+    d = sigmoid(z_out) - y
+    for i in reversed(range(len(Thetas))):
+        Theta_grads[i][:,0] = d.sum(axis=0)
+        Theta_grads[i][:,1:] = d.T @ layers[i]
+        Theta_grads[i] /= m
+        if i > 0:
+            # The bias unit has no inputs, so its column doesn't feed back.
+            d = (d @ Thetas[i][:,1:]) * act_gradient(layers[i])
+        start = _lap(timings, (i, 'backward'), start)
+    
+    # Regularization, the bias weights aren't included.
+    if my_lambda:
+        for Theta, Theta_grad in zip(Thetas, Theta_grads):
+            J += my_lambda/(2*m) * np.sum(Theta[:,1:]**2)
+            Theta_grad[:,1:] += my_lambda/m * Theta[:,1:]
+    
+    return(J, grad)
+
+def predict_layers(nn_params, layer_sizes, X, activation='sigmoid'):
+    # The sigmoid doesn't change which output is largest, so it's skipped for the output layer.
+    return np.argmax(feed_forward(unpack_params(nn_params, layer_sizes), X, activation)[-1], axis=1)
+
+
 # +
 def predict(Theta1, Theta2, X):
-    h1 = sigmoid( np.insert(X, 0, 1, axis=1) @ Theta1.T)
-    h2 = sigmoid( np.insert(h1, 0, 1, axis=1) @ Theta2.T)
+    # Same dtype handling as NNCostGradFunction.
+    dtype = np.result_type(X.dtype, np.float32)
+    Theta1, Theta2 = Theta1.astype(dtype, copy=False), Theta2.astype(dtype, copy=False)
+    h1 = sigmoid( X @ Theta1[:,1:].T + Theta1[:,0])
+    h2 = sigmoid( h1 @ Theta2[:,1:].T + Theta2[:,0])
     return np.argmax(h2,axis=1)
 
+class DigitNetwork:
+    """The same two-layer network as NNCostGradFunction, set up for the training loop.
+    
+    The weights and biases are kept in separate arrays (so nothing needs a column of ones inserted), and every
+    activation, delta and gradient has a buffer sized for batch_sz that gets reused for each batch. After the first
+    batch a training epoch allocates next to nothing. Batches smaller than batch_sz (like the last one) use the
+    front of the buffers.
+    
+    Everything is computed in dtype, except the cost which is always added up in float64. The batches should be
+    in dtype too, or numpy will convert each one before the matrix products.
+    
+    Set timings to a dict to have each layer's forward pass, backward pass and update times appended to it.
+    """
+    
+    def __init__(self, input_layer_sz, hidden_layer_sz, num_labels, batch_sz, dtype=np.float64):
+        self.input_layer_sz = input_layer_sz
+        self.hidden_layer_sz = hidden_layer_sz
+        self.num_labels = num_labels
+        self.batch_sz = batch_sz
+        self.dtype = dtype
+        self.timings = None
+        
+        self.W1 = np.zeros((hidden_layer_sz, input_layer_sz), dtype=dtype)
+        self.b1 = np.zeros(hidden_layer_sz, dtype=dtype)
+        self.W2 = np.zeros((num_labels, hidden_layer_sz), dtype=dtype)
+        self.b2 = np.zeros(num_labels, dtype=dtype)
+        
+        self.W1_grad = np.zeros_like(self.W1)
+        self.b1_grad = np.zeros_like(self.b1)
+        self.W2_grad = np.zeros_like(self.W2)
+        self.b2_grad = np.zeros_like(self.b2)
+        
+        self._labels = np.arange(num_labels)
+        self._a2 = np.empty((batch_sz, hidden_layer_sz), dtype=dtype)
+        self._z3 = np.empty((batch_sz, num_labels), dtype=dtype)
+        self._a3 = np.empty((batch_sz, num_labels), dtype=dtype)
+        self._y = np.empty((batch_sz, num_labels), dtype=bool)
+        self._h = np.empty((batch_sz, num_labels), dtype=dtype)
+        self._s2 = np.empty((batch_sz, hidden_layer_sz), dtype=dtype)
+        self._d2 = np.empty((batch_sz, hidden_layer_sz), dtype=dtype)
+        self._d3 = np.empty((batch_sz, num_labels), dtype=dtype)
+    
+    @classmethod
+    def from_params(cls, nn_params, input_layer_sz, hidden_layer_sz, num_labels, batch_sz, dtype=np.float64):
+        model = cls(input_layer_sz, hidden_layer_sz, num_labels, batch_sz, dtype)
+        model.set_params(nn_params)
+        return model
+    
+    def set_params(self, nn_params):
+        """Copy in the weights from a flat nn_params vector (the layout NNCostFunction uses)."""
+        split = self.hidden_layer_sz*(self.input_layer_sz+1)
+        Theta1 = nn_params[:split].reshape(self.hidden_layer_sz, self.input_layer_sz+1)
+        Theta2 = nn_params[split:].reshape(self.num_labels, self.hidden_layer_sz+1)
+        self.b1[:], self.W1[:] = Theta1[:,0], Theta1[:,1:]
+        self.b2[:], self.W2[:] = Theta2[:,0], Theta2[:,1:]
+    
+    def params(self):
+        """The weights as a flat nn_params vector."""
+        Theta1 = np.column_stack((self.b1, self.W1))
+        Theta2 = np.column_stack((self.b2, self.W2))
+        return np.concatenate((Theta1.flatten(), Theta2.flatten()))
+    
+    def forward(self, X):
+        """Feed X through the network, returns the output layer (a view of the buffer, so it's overwritten by
+        the next call)."""
+        m = X.shape[0]
+        a2, z3, a3 = self._a2[:m], self._z3[:m], self._a3[:m]
+        
+        start = time.perf_counter()
+        np.matmul(X, self.W1.T, out=a2)
+        a2 += self.b1
+        sigmoid(a2, out=a2)
+        start = _lap(self.timings, (0, 'forward'), start)
+        
+        # z3 is kept for the cost
+        np.matmul(a2, self.W2.T, out=z3)
+        z3 += self.b2
+        sigmoid(z3, out=a3)
+        _lap(self.timings, (1, 'forward'), start)
+        return a3
+    
+    def cost_grad(self, X, y):
+        """Same as NNCostGradFunction, except the gradients go into the *_grad arrays. Returns the cost."""
+        m = X.shape[0]
+        a2, y_mat, h, s2 = self._a2[:m], self._y[:m], self._h[:m], self._s2[:m]
+        d2, d3 = self._d2[:m], self._d3[:m]
+        a3 = self.forward(X)
+        
+        np.equal(y.reshape(m,1), self._labels, out=y_mat)
+        
+        # -log(h) where y is 1 and -log(1-h) where it's 0, which are logaddexp(0, -z3) and logaddexp(0, z3).
+        np.copyto(h, self._z3[:m])
+        np.negative(h, out=h, where=y_mat)
+        np.logaddexp(0, h, out=h)
+        J = h.sum(dtype=np.float64) / m
+        
+        # Backpropagation, rows are examples, one layer at a time from the output. sigmoidGradient(z_2) is a2*(1-a2).
+        start = time.perf_counter()
+        np.subtract(a3, y_mat, out=d3)
+        np.matmul(d3.T, a2, out=self.W2_grad)
+        np.sum(d3, axis=0, out=self.b2_grad)
+        self.W2_grad /= m
+        self.b2_grad /= m
+        np.matmul(d3, self.W2, out=d2)
+        d2 *= a2
+        np.subtract(1, a2, out=s2)
+        d2 *= s2
+        start = _lap(self.timings, (1, 'backward'), start)
+        
+        np.matmul(d2.T, X, out=self.W1_grad)
+        np.sum(d2, axis=0, out=self.b1_grad)
+        self.W1_grad /= m
+        self.b1_grad /= m
+        _lap(self.timings, (0, 'backward'), start)
+        
+        return J
+    
+    def step(self, alpha):
+        """Gradient descent step with the gradients from the last cost_grad. They get scaled by alpha in place."""
+        start = time.perf_counter()
+        for layer, (W, W_grad, b, b_grad) in enumerate([(self.W1, self.W1_grad, self.b1, self.b1_grad),
+                                                         (self.W2, self.W2_grad, self.b2, self.b2_grad)]):
+            for param, grad in ((W, W_grad), (b, b_grad)):
+                grad *= alpha
+                param -= grad
+            start = _lap(self.timings, (layer, 'update'), start)
+    
+    def predict(self, X):
+        """Predicted labels for X, fed through batch_sz examples at a time."""
+        predictions = np.empty(X.shape[0], dtype=np.int64)
+        for i in range(0, X.shape[0], self.batch_sz):
+            np.argmax(self.forward(X[i:i+self.batch_sz]), axis=1, out=predictions[i:i+self.batch_sz])
+        return predictions
+
+def predict_csv(Theta1, Theta2, images, mu, sigma, output_path, chunksize=5000, dtype=np.float32):
+    """Predict the labels for images and write them out as a submission, one chunk at a time.
+    
+    images is either the path of a CSV file, which is read in chunks, or an array of raw pixels (like the memory
+    mapped ones from load_digit_csv), which is sliced into chunks. Each chunk is normalized with mu and sigma (the training set's, so the test images get the same scaling the
+    network was trained on) and fed forward in dtype. Only one chunk is ever in memory, however big the file is.
+    Returns the number of images.
+    """
+    W1, b1 = Theta1[:,1:].T.astype(dtype), Theta1[:,0].astype(dtype)
+    W2, b2 = Theta2[:,1:].T.astype(dtype), Theta2[:,0].astype(dtype)
+    # A pixel that's constant in the training set normalizes to 0 there. 1/epsilon doesn't fit in a float32, so
+    # those pixels get a scale of 0 instead (the network never learned anything from them anyway).
+    scale = np.where(sigma > 0, 1/(sigma+normalize_epsilon), 0).astype(dtype)
+    mu = mu.astype(dtype)
+    
+    image_id = 0
+    with open(output_path, 'w') as f:
+        f.write('ImageId,Label\n')
+        if isinstance(images, str):
+            chunks = (chunk.loc[:, chunk.columns != 'label'] for chunk in pd.read_csv(images, chunksize=chunksize, dtype=np.uint8))
+        else:
+            chunks = (images[i:i+chunksize] for i in range(0, len(images), chunksize))
+        
+        for chunk in chunks:
+            X = np.asarray(chunk, dtype=dtype)
+            X -= mu
+            X *= scale
+            
+            h1 = X @ W1
+            h1 += b1
+            with np.errstate(over='ignore'):
+                sigmoid(h1, out=h1)
+            # The sigmoid doesn't change which output is largest, so it's skipped for the output layer.
+            labels = np.argmax(h1 @ W2 + b2, axis=1)
+            
+            ids = np.arange(image_id + 1, image_id + len(labels) + 1)
+            np.savetxt(f, np.column_stack((ids, labels)), fmt='%d', delimiter=',')
+            image_id += len(labels)
+    
+    return image_id
+
+class BatchIterator:
+    """Mini-batches of (X, y) for training.
+    
+    With shuffle, each epoch goes through the examples in a different order, from a permutation seeded by seed and
+    the epoch number (so a run can be repeated exactly). With prefetch, the next few batches are sliced out,
+    normalized (if X is a NormalizedView) and converted to dtype on a background thread while the current one is
+    being trained on. numpy releases the GIL for the copies and the matrix products, so the two overlap.
+    
+    last_batch says what to do when the examples don't divide evenly into batches: 'keep' a smaller last batch,
+    'drop' it, or 'pad' it out to batch_sz with examples from the start of the epoch.
+    """
+    
+    def __init__(self, X, y, batch_sz, shuffle=True, seed=0, prefetch=2, dtype=None, last_batch='keep'):
+        if last_batch not in ('keep', 'drop', 'pad'):
+            raise ValueError("last_batch should be 'keep', 'drop' or 'pad', not " + repr(last_batch))
+        self.X = X
+        self.y = y
+        self.batch_sz = batch_sz
+        self.shuffle = shuffle
+        self.seed = seed
+        self.prefetch = prefetch
+        self.dtype = dtype
+        self.last_batch = last_batch
+        self._epoch = 0
+    
+    def __len__(self):
+        if self.last_batch == 'drop':
+            return len(self.y) // self.batch_sz
+        return -(-len(self.y) // self.batch_sz)
+    
+    def __iter__(self):
+        """Iterates over the next epoch."""
+        self._epoch += 1
+        return self.epoch(self._epoch - 1)
+    
+    def _batch_indices(self, epoch):
+        m = len(self.y)
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, epoch]).permutation(m)
+        else:
+            order = np.arange(m)
+        
+        for i in range(0, m, self.batch_sz):
+            if i + self.batch_sz > m:
+                if self.last_batch == 'drop':
+                    break
+                if self.last_batch == 'pad':
+                    # np.resize repeats order as many times as needed, in case there's less than a batch of it.
+                    yield np.sort(np.concatenate((order[i:], np.resize(order, i + self.batch_sz - m))))
+                    break
+            if self.shuffle:
+                # Sorted so the rows are read in order, which is much kinder to memory mapped data.
+                yield np.sort(order[i:i+self.batch_sz])
+            else:
+                yield slice(i, i+self.batch_sz)
+    
+    def _load(self, idx):
+        X_batch = self.X[idx]
+        if self.dtype is not None:
+            X_batch = np.asarray(X_batch, dtype=self.dtype)
+        return X_batch, np.asarray(self.y[idx])
+    
+    def epoch(self, epoch):
+        """Batches for the given epoch number."""
+        if not self.prefetch:
+            for idx in self._batch_indices(epoch):
+                yield self._load(idx)
+            return
+        
+        ready = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        
+        def put(item):
+            # Gives up if the consumer went away, instead of blocking on a full queue forever.
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def loader():
+            try:
+                for idx in self._batch_indices(epoch):
+                    if not put(self._load(idx)):
+                        return
+                put(None)
+            except Exception as ex:
+                put(ex)
+        
+        thread = threading.Thread(target=loader, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = ready.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+def train_sgd(model, X, y, alpha, iterations, verbose=False, **batch_options):
+    """Mini-batch gradient descent on model, in batches of model.batch_sz. Returns the cost after each iteration.
+    
+    batch_options go to BatchIterator (shuffle, seed, prefetch, dtype and last_batch).
+    """
+    batches = BatchIterator(X, y, model.batch_sz, **batch_options)
+    Jhist = np.zeros(iterations)
+    
+    for iters in range(iterations):
+        for i, (X_batch, y_batch) in enumerate(batches):
+            # The cost comes from the same forward pass as the gradient, so it's the cost just before this update.
+            J = model.cost_grad(X_batch, y_batch)
+            model.step(alpha)
+            
+            if verbose:
+                print("\rIteration: {} Batch: {}  Cost: {}".format(iters,i,J), end='', flush=True)
+        Jhist[iters] = J
+    
+    return Jhist
+
 def mycallback(result):
     global NFeval
     print("Iteration Number: ", str(NFeval))
     NFeval+=1
 
+
+# -
+
+# ## Hyperparameter sweep
+# Training one setting at a time only uses one core (or whatever BLAS manages with 500 row batches). The sweep
+# below trains every combination of settings at once in a pool of processes. The training and validation data go
+# into shared memory once, and each worker maps it instead of being sent its own copy.
+
 # +
-# Main Code Setup
-# Initially limtiting this to the first 5 entries for testing purposes.
+def share_array(array):
+    """Copy array into a new shared memory block. Returns the block and what a worker needs to attach to it."""
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def attach_array(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+# The shared arrays in each worker process, set up by _init_sweep_worker.
+_sweep_data = {}
+
+def _init_sweep_worker(specs):
+    # Each worker gets one BLAS thread, the parallelism comes from the pool.
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+    for key, (spec, normalization) in specs.items():
+        shm, array = attach_array(spec)
+        _sweep_data[key] = (shm, array if normalization is None else NormalizedView(array, *normalization))
+
+def _train_config(config):
+    X_train, y_train = _sweep_data['X_train'][1], _sweep_data['y_train'][1]
+    X_val, y_val = _sweep_data['X_val'][1], _sweep_data['y_val'][1]
+    (input_layer_sz, hidden_layer_sz, num_labels) = (X_train.shape[1], config['hidden_layer_sz'], config['num_labels'])
+    
+    # Same starting weights for every run with the same hidden layer size, so only the other settings differ.
+    rng = np.random.default_rng(config['seed'])
+    init_epsilon = 0.12
+    nn_params = rng.random(hidden_layer_sz*(input_layer_sz+1) + num_labels*(hidden_layer_sz+1))*init_epsilon*2 - init_epsilon
+    
+    start = time.perf_counter()
+    model = DigitNetwork.from_params(nn_params, input_layer_sz, hidden_layer_sz, num_labels, config['batch_sz'],
+                                     dtype=X_train.dtype)
+    Jhist = train_sgd(model, X_train, y_train, config['alpha'], config['iterations'])
+    train_time = time.perf_counter() - start
+    
+    fscore = f1_score(y_val, model.predict(X_val), average='micro')
+    return dict(config, cost=Jhist[-1], f1=fscore, train_time=train_time, Jhist=Jhist)
 
+def hyperparameter_sweep(X_train, y_train, X_val, y_val, alphas, hidden_layer_szs=(25,), batch_szs=(500,),
+                         iterations=(5,), num_labels=10, workers=None, seed=0):
+    """Train a DigitNetwork for every combination of the settings, spread over a pool of workers processes.
+    
+    Returns a DataFrame with one row per combination: the settings, the final training cost, F1 score on the
+    validation set, training time and the cost history (Jhist).
+    """
+    configs = [dict(alpha=alpha, hidden_layer_sz=hidden, batch_sz=batch, iterations=iters, num_labels=num_labels,
+                    seed=seed)
+               for alpha, hidden, batch, iters in itertools.product(alphas, hidden_layer_szs, batch_szs, iterations)]
+    
+    # A NormalizedView shares its raw pixels, and the workers normalize them batch by batch the same way.
+    shared, specs = [], {}
+    try:
+        for key, array in [('X_train', X_train), ('y_train', y_train), ('X_val', X_val), ('y_val', y_val)]:
+            normalization = None
+            if isinstance(array, NormalizedView):
+                normalization = (array.mu, array.sigma, array.dtype)
+                array = array.X
+            shm, spec = share_array(np.ascontiguousarray(array))
+            shared.append(shm)
+            specs[key] = (spec, normalization)
+        
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('fork'),
+                                 initializer=_init_sweep_worker, initargs=(specs,)) as pool:
+            results = list(pool.map(_train_config, configs))
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+    
+    return pd.DataFrame(results)
 
-X = train.loc[:, train.columns != 'label'].to_numpy()
-y = train.loc[:, 'label'].to_numpy()
+# ## Dataset cache
+# Parsing the CSVs takes a while, and pandas reads the pixels into int64 which is 8 times the memory they need.
+# The first time through, load_digit_csv converts each CSV to uint8 .npy files in `dataset_cache_dir`, with a
+# header of the CSV's size, modification time and checksum. After that it memory maps the .npy files, which takes
+# milliseconds and doesn't copy anything. Size and mtime are checked first, the CSV is only rehashed if they changed.
+#
+# NormalizedView normalizes the uint8 pixels as they're sliced, so the training loop normalizes one batch at a
+# time instead of keeping a float64 copy of everything.
 
-# TODO: Do this with a standardization pipeline. Which will probably fix the div0 issues too. 
-X_norm = normalize(X)
+# +
+dataset_cache_dir = 'digit_cache'
+
+def csv_checksum(path, block_sz=1 << 20):
+    """sha256 of the CSV, kept in the cache header so a changed file is parsed again even if its size is the same."""
+    digest = hashlib.sha256()
+    buffer = bytearray(block_sz)
+    with open(path, 'rb') as f:
+        while (n := f.readinto(buffer)):
+            digest.update(memoryview(buffer)[:n])
+    return digest.hexdigest()
+
+def load_digit_csv(path, cache_dir=dataset_cache_dir):
+    """Load a digit recognizer CSV as uint8 arrays, through the cache.
+    
+    Returns the pixels (images x 784) and the labels (None for test.csv), memory mapped read only.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    header_file = os.path.join(cache_dir, name + '.json')
+    pixels_file = os.path.join(cache_dir, name + '-pixels.npy')
+    labels_file = os.path.join(cache_dir, name + '-labels.npy')
+    
+    stat = os.stat(path)
+    try:
+        with open(header_file) as f:
+            header = json.load(f)
+    except FileNotFoundError:
+        header = {}
+    # If any of the arrays have gone missing the header doesn't count, and the CSV gets converted again.
+    if not os.path.exists(pixels_file) or (header.get('labels') and not os.path.exists(labels_file)):
+        header = {}
+    
+    checksum = None
+    fresh = header.get('size') == stat.st_size and header.get('mtime') == stat.st_mtime
+    if not fresh and header.get('size') == stat.st_size:
+        checksum = csv_checksum(path)
+        fresh = header.get('sha256') == checksum
+    if fresh and header['mtime'] != stat.st_mtime:
+        # Touched but not changed
+        header['mtime'] = stat.st_mtime
+        with open(header_file, 'w') as f:
+            json.dump(header, f, indent=1)
+    
+    if not fresh:
+        data = pd.read_csv(path, dtype=np.uint8)
+        has_labels = 'label' in data.columns
+        
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(pixels_file, data.loc[:, data.columns != 'label'].to_numpy())
+        if has_labels:
+            np.save(labels_file, data['label'].to_numpy())
+        del data
+        
+        header = {'source': path, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                  'sha256': checksum or csv_checksum(path), 'labels': has_labels}
+        # Written last, so an interrupted conversion just gets redone next time.
+        with open(header_file, 'w') as f:
+            json.dump(header, f, indent=1)
+    
+    pixels = np.load(pixels_file, mmap_mode='r')
+    labels = np.load(labels_file, mmap_mode='r') if header['labels'] else None
+    return pixels, labels
 
-# Code section for PCA
-# The following is based on Interactive Intro to Dimensionality Reduction on Kaggle. 
+class NormalizedView:
+    """Raw pixels that get normalized (with the given mu and sigma) when they're sliced.
+    
+    It has a shape and slices like an array, which is all train_sgd and DigitNetwork need. np.asarray(view) gives
+    the whole thing normalized, for the code that needs every row at once.
+    """
+    
+    def __init__(self, X, mu, sigma, dtype=np.float64):
+        self.X = X
+        self.mu = mu
+        self.sigma = sigma
+        self.dtype = dtype
+        # normalize's epsilon doesn't fit in a float32. It only matters for pixels that are the same in every
+        # image, which come out as 0 either way, so they're just divided by 1.
+        self._mu = mu.astype(dtype)
+        self._sigma = np.where(sigma > 0, sigma + normalize_epsilon, 1).astype(dtype)
+    
+    @property
+    def shape(self):
+        return self.X.shape
+    
+    def __len__(self):
+        return len(self.X)
+    
+    def __getitem__(self, key):
+        # Converted straight to dtype, so a float32 view never makes a float64 copy.
+        X = np.array(self.X[key], dtype=self.dtype)
+        X -= self._mu
+        X /= self._sigma
+        return X
+    
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype, copy=False)
+    
+
+
+# -
+
+# ## PCA
+# The PCA section originally did a general eigendecomposition of the covariance matrix to get the variance curve,
+# then had sklearn do its own decomposition all over again for the projection. FastPCA does one decomposition
+# for both. Since the covariance matrix is symmetric it can use eigh, or a randomized SVD when only the first
+# few components are wanted. The fitted basis is saved to disk, keyed by a hash of the data, so rerunning the
+# notebook on the same data skips the decomposition entirely.
+
+# +
+def dataset_hash(X):
+    """Hash of an array's contents, shape and dtype."""
+    X = np.ascontiguousarray(X)
+    digest = hashlib.sha1(str((X.shape, X.dtype.str)).encode())
+    digest.update(X.data)
+    return digest.hexdigest()
+
+class FastPCA:
+    """PCA with a choice of solver and an on-disk cache of the fitted basis.
+    
+    solver is 'eigh' (eigendecomposition of the covariance matrix, every component) or 'randomized' (randomized
+    SVD of the data, only the first n_components). After fit, the components are the rows of components_ in
+    order of decreasing variance, and explained_variance_ratio_ is each one's fraction of the total variance.
+    """
+    
+    def __init__(self, solver='eigh', n_components=None, cache_dir=None, random_state=0):
+        if solver == 'randomized' and n_components is None:
+            raise ValueError("The randomized solver needs n_components")
+        if solver not in ('eigh', 'randomized'):
+            raise ValueError("Unknown solver: " + solver)
+        self.solver = solver
+        self.n_components = n_components
+        self.cache_dir = cache_dir
+        self.random_state = random_state
+    
+    def fit(self, X):
+        (m, n) = X.shape
+        cache_file = None
+        if self.cache_dir is not None:
+            key = dataset_hash(X) + '-{}-{}-{}'.format(self.solver, self.n_components, self.random_state)
+            cache_file = os.path.join(self.cache_dir, 'pca-' + hashlib.sha1(key.encode()).hexdigest() + '.npz')
+            if os.path.exists(cache_file):
+                with np.load(cache_file) as cached:
+                    self.mean_ = cached['mean']
+                    self.components_ = cached['components']
+                    self.explained_variance_ = cached['explained_variance']
+                    self.total_variance_ = cached['total_variance'].item()
+                self.explained_variance_ratio_ = self.explained_variance_ / self.total_variance_
+                return self
+        
+        self.mean_ = X.mean(axis=0)
+        X_centered = X - self.mean_
+        # The total variance is the trace of the covariance matrix, the randomized solver needs it for the ratios.
+        self.total_variance_ = np.einsum('ij,ij->', X_centered, X_centered) / (m - 1)
+        
+        if self.solver == 'eigh':
+            evals, evecs = np.linalg.eigh(X_centered.T @ X_centered / (m - 1))
+            # eigh sorts the eigenvalues in ascending order, and the eigenvectors are its columns.
+            order = slice(None, None if self.n_components is None else -self.n_components - 1, -1)
+            self.explained_variance_ = np.clip(evals[order], 0, None)
+            self.components_ = evecs[:, order].T.copy()
+        else:
+            U, S, Vt = randomized_svd(X_centered, self.n_components, random_state=self.random_state)
+            self.explained_variance_ = S**2 / (m - 1)
+            self.components_ = Vt
+        self.explained_variance_ratio_ = self.explained_variance_ / self.total_variance_
+        
+        if cache_file is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(cache_file, mean=self.mean_, components=self.components_,
+                     explained_variance=self.explained_variance_, total_variance=self.total_variance_)
+        return self
+    
+    def n_components_for(self, variance):
+        """Number of components needed to explain more than variance (a fraction) of the total."""
+        enough = np.cumsum(self.explained_variance_ratio_) > variance
+        if not enough.any():
+            # argmax of all False would quietly give 1 component
+            raise ValueError("The {} fitted components only explain {:.3f} of the variance, not {}. Increase "
+                             "n_components.".format(len(enough), self.explained_variance_ratio_.sum(), variance))
+        return int(np.argmax(enough)) + 1
+    
+    def transform(self, X, n_components=None):
+        return (X - self.mean_) @ self.components_[:n_components].T
+    
+    def fit_transform(self, X, variance=0.90):
+        """Fit on X and project it onto enough components to explain variance of the total.
+        
+        Returns the projection and the cumulative explained variance curve.
+        """
+        self.fit(X)
+        return self.transform(X, self.n_components_for(variance)), np.cumsum(self.explained_variance_ratio_)
+    
 
-# Caclulate the covariant matrix first.
 
-X_cov = np.cov(X_norm.T)
+# +
+# Main Code Setup
+# Initially limtiting this to the first 5 entries for testing purposes.
 
-evals, evecs = np.linalg.eig(X_cov)
 
+X, y = load_digit_csv(train_path)
 
-eig_pairs = [ ( np.abs(evals[i]), evecs[i]) for i in range(len(evals)) ]
+# TODO: Do this with a standardization pipeline. Which will probably fix the div0 issues too. 
+train_mu, train_sigma = normalization_stats(X)
+X_norm = NormalizedView(X, train_mu, train_sigma, dtype=compute_dtype)
 
-eig_pairs.sort(key = lambda x: x[0], reverse = True)
+# Code section for PCA
+# The following is based on Interactive Intro to Dimensionality Reduction on Kaggle. 
+# Set pca_solver to 'randomized' (with pca_max_components) to only find the first few components.
 
-eval_tot = sum(evals)
+pca_solver = 'eigh'
+pca_max_components = None
+pca_cache_dir = 'pca_cache'
 
-indvdl_contribs = [(i/eval_tot) for i in sorted(evals, reverse=True)]
-overal_contribsz = np.cumsum(indvdl_contribs)
+pca = FastPCA(solver=pca_solver, n_components=pca_max_components, cache_dir=pca_cache_dir)
 
 # We want to find out where the eigenvectors contribute over 90% of our variance. 
-np.argmax(overal_contribs > 0.90)
+X_new, overal_contribs = pca.fit_transform(np.asarray(X_norm), variance=0.90)
+X_new.shape[1]
 # -
 
 # Just for fun let's take a look at it
-plt.plot(np.arange(len(evals)), overal_contribs )
-
-# +
-# Now for some actual PCA
-# Using 228 components
-
-pca = PCA(n_components=228)
-pca.fit(X_norm)
-X_new = pca.transform(X_norm)
+plt.plot(np.arange(len(overal_contribs)), overal_contribs )
 
 
 # +
 # Now that we've normalized and reduced the data split it into a validation and training set.
 
-X_train, X_val, y_train, y_val = train_test_split(X_norm, y)
+# The split is done on the raw pixels, the batches get normalized as they're used.
+train_idx, val_idx = train_test_split(np.arange(len(y)))
+X_train = NormalizedView(X[train_idx], train_mu, train_sigma, dtype=compute_dtype)
+X_val = NormalizedView(X[val_idx], train_mu, train_sigma, dtype=compute_dtype)
+y_train, y_val = y[train_idx], y[val_idx]
 
 
 # Various useful constants
@@ -264,28 +1064,17 @@ init_params = np.concatenate((Theta1.flatten(),Theta2.flatten()))
 #                            jac=NNGradFunction, tol=mytol, options={'disp': True, 'maxiter':50, 'gtol':mytol }, callback=mycallback)
 
 
-for alpha in alphas:
-    params = np.copy(init_params)
-
-    Jhist = np.zeros(iterations)
-
-    # TODO: Do some of this with args and kwargs.
-    for iters in range(iterations):
-        # Using a factor of 0.1 as a base starting point
-        for i in range(0,m,batch_sz):
-            grad = NNGradFunction(params, input_layer_sz, hidden_layer_sz, num_labels, X_train[i:i+batch_sz], y_train[i:i+batch_sz])
-
-            params = params - alpha*grad
-            J = NNCostFunction(params, input_layer_sz, hidden_layer_sz, num_labels, X_train[i:i+batch_sz], y_train[i:i+batch_sz])
+# One set of weights and buffers, reset for each alpha.
+model = DigitNetwork(input_layer_sz, hidden_layer_sz, num_labels, batch_sz, dtype=compute_dtype)
 
-            print("\rIteration: {} Batch Start: {}  Cost: {}".format(iters,i,J), end='', flush=True)
-        Jhist[iters] = J
+for alpha in alphas:
+    model.set_params(init_params)
 
-    Theta1 = params[:hidden_layer_sz*(input_layer_sz+1)].reshape(hidden_layer_sz,input_layer_sz+1)
-    Theta2 = params[hidden_layer_sz*(input_layer_sz+1):].reshape(num_labels,hidden_layer_sz+1)
+    Jhist = train_sgd(model, X_train, y_train, alpha, iterations, verbose=True)
 
+    params = model.params()
 
-    val_predictions = predict(Theta1, Theta2, X_val)
+    val_predictions = model.predict(X_val)
     fscore = f1_score(y_val,val_predictions,average='micro')
 
     plt.figure()
@@ -296,6 +1085,53 @@ for alpha in alphas:
     plt.legend(['Training','Validation'])
     plt.show()
 
+# +
+# Set this to train a deeper network as well, e.g. [input_layer_sz, 128, 64, num_labels].
+deep_layer_sizes = None
+deep_activation = 'relu'
+deep_alpha = 0.1
+deep_lambda = 1
+
+if deep_layer_sizes:
+    deep_params = init_layer_params(deep_layer_sizes, deep_activation, seed=0).astype(compute_dtype)
+    deep_batches = BatchIterator(X_train, y_train, batch_sz)
+    deep_Jhist = np.zeros(iterations)
+    
+    for iters in range(iterations):
+        for X_batch, y_batch in deep_batches:
+            J, grad = NNLayersCostGradFunction(deep_params, deep_layer_sizes, X_batch, y_batch, deep_lambda, deep_activation)
+            deep_params -= deep_alpha*grad
+        deep_Jhist[iters] = J
+    
+    fscore = f1_score(y_val, predict_layers(deep_params, deep_layer_sizes, X_val[:], deep_activation), average='micro')
+    
+    plt.figure()
+    plt.plot(np.arange(iterations), deep_Jhist)
+    plt.title("Layers: {} F1 Score: {}".format(deep_layer_sizes, fscore))
+    plt.xlabel("Iterations")
+    plt.ylabel("Cost")
+    plt.show()
+
+# +
+# Set this to the number of processes to use to run a wider sweep of settings in parallel.
+sweep_workers = None
+
+if sweep_workers:
+    sweep = hyperparameter_sweep(X_train, y_train, X_val, y_val, alphas, hidden_layer_szs=[25, 50, 100],
+                                 batch_szs=[100, 500], iterations=[iterations], num_labels=num_labels,
+                                 workers=sweep_workers)
+    sweep = sweep.sort_values('f1', ascending=False)
+    print(sweep.drop(columns=['Jhist', 'num_labels', 'seed']).to_string(index=False))
+    
+    # Cost histories of the 5 best settings
+    plt.figure()
+    for _, row in sweep.head(5).iterrows():
+        plt.plot(np.arange(row['iterations']), row['Jhist'],
+                 label="Alpha: {} Hidden: {} Batch: {}".format(row['alpha'], row['hidden_layer_sz'], row['batch_sz']))
+    plt.xlabel("Iterations")
+    plt.ylabel("Cost")
+    plt.legend()
+    plt.show()
 # -
 
 
@@ -305,14 +1141,17 @@ for alpha in alphas:
 mytol = 1e-3
 NFeval = 1
 
-fmin = optimize.minimize(fun=NNCostFunction, x0=params, args=(input_layer_sz, hidden_layer_sz, num_labels, X_new, y), method='CG',
-                            jac=NNGradFunction, tol=mytol, options={'disp': True, 'maxiter':50, 'gtol':mytol }, callback=mycallback)
+# Starting from where the last SGD run left off, on all of the normalized data (the parameters are sized for the
+# full 784 pixels, not the PCA components). CG works on all of it at once, so this is where it all gets normalized.
+X_all = np.asarray(X_norm)
+fmin = optimize.minimize(fun=NNCostGradFunction, x0=params, args=(input_layer_sz, hidden_layer_sz, num_labels, X_all, y), method='CG',
+                            jac=True, tol=mytol, options={'disp': True, 'maxiter':50, 'gtol':mytol }, callback=mycallback)
 
 # +
 fTheta1 = fmin.x[:hidden_layer_sz*(input_layer_sz+1)].reshape(hidden_layer_sz,input_layer_sz+1)
 fTheta2 = fmin.x[hidden_layer_sz*(input_layer_sz+1):].reshape(num_labels,hidden_layer_sz+1)
 
-fmin_predictions = predict(fTheta1, fTheta2, X_new)
+fmin_predictions = predict(fTheta1, fTheta2, X_all)
 
 f1_score(y,fmin_predictions,average='micro')
 
@@ -320,14 +1159,252 @@ f1_score(y,fmin_predictions,average='micro')
 # +
 #Actual predictions here
 
-X_test = test.loc[:, test.columns != 'label'].to_numpy()
-X_test_norm = normalize(X_test)
+# Streamed through in chunks from the cache, normalized with the training set's mean and standard deviation.
+X_test, _ = load_digit_csv(test_path)
+predict_csv(fTheta1, fTheta2, X_test, train_mu, train_sigma, 'submission.csv', dtype=compute_dtype)
+# -
 
-test_predictions = predict(fTheta1, fTheta2, X_test_norm)
+# ## Benchmarks
+# Where the training speedups came from, step by step: looping over examples vs. whole batches, the fused cost and
+# gradient, DigitNetwork's reused buffers, prefetching batches, and float32. Each one is measured on a slice of the
+# training data when `run_benchmarks` is True.
 
-output = pd.DataFrame({'ImageId': test.index+1,
-                       'Label': test_predictions})
-output.to_csv('submission.csv', index=False)
-# -
+# +
+# Backpropagation one example at a time vs. the whole batch at once, on a few thousand training examples.
+if run_benchmarks:
+    bench_X = X_train[:5000]
+    bench_y = y_train[:5000]
+    
+    start = time.perf_counter()
+    loop_grad = NNGradFunction_loop(init_params, input_layer_sz, hidden_layer_sz, num_labels, bench_X, bench_y)
+    loop_time = time.perf_counter() - start
+    
+    # The vectorized version is fast enough that it's worth averaging a few runs.
+    start = time.perf_counter()
+    for _ in range(10):
+        batch_grad = NNGradFunction(init_params, input_layer_sz, hidden_layer_sz, num_labels, bench_X, bench_y)
+    batch_time = (time.perf_counter() - start) / 10
+    
+    print("Examples: {:,}  loop: {:.3f} s  vectorized: {:.4f} s  speedup: {:.0f}x  max difference: {:.2e}".format(
+        len(bench_X), loop_time, batch_time, loop_time / batch_time, np.abs(loop_grad - batch_grad).max()))
+
+# +
+# Separate cost and gradient calls (what the training loop used to do) vs. the fused NNCostGradFunction.
+if run_benchmarks:
+    start = time.perf_counter()
+    for _ in range(10):
+        separate = (NNCostFunction(init_params, input_layer_sz, hidden_layer_sz, num_labels, bench_X, bench_y),
+                    NNGradFunction(init_params, input_layer_sz, hidden_layer_sz, num_labels, bench_X, bench_y))
+    separate_time = (time.perf_counter() - start) / 10
+    
+    start = time.perf_counter()
+    for _ in range(10):
+        fused = NNCostGradFunction(init_params, input_layer_sz, hidden_layer_sz, num_labels, bench_X, bench_y)
+    fused_time = (time.perf_counter() - start) / 10
+    
+    print("Examples: {:,}  separate: {:.4f} s  fused: {:.4f} s  speedup: {:.1f}x  cost difference: {:.2e}".format(
+        len(bench_X), separate_time, fused_time, separate_time / fused_time, abs(separate[0] - fused[0])))
+
+# +
+# Memory allocated during a training epoch with the fused function vs. DigitNetwork's reused buffers.
+if run_benchmarks:
+    import tracemalloc
+    
+    def epoch_fused(params):
+        for i in range(0, len(bench_X), batch_sz):
+            J, grad = NNCostGradFunction(params, input_layer_sz, hidden_layer_sz, num_labels, bench_X[i:i+batch_sz], bench_y[i:i+batch_sz])
+            params -= 0.1*grad
+    
+    def epoch_model(model):
+        for i in range(0, len(bench_X), batch_sz):
+            model.cost_grad(bench_X[i:i+batch_sz], bench_y[i:i+batch_sz])
+            model.step(0.1)
+    
+    bench_model = DigitNetwork.from_params(init_params, input_layer_sz, hidden_layer_sz, num_labels, batch_sz,
+                                           dtype=compute_dtype)
+    for name, epoch, arg in [('fused', epoch_fused, np.copy(init_params)), ('DigitNetwork', epoch_model, bench_model)]:
+        # The first epoch is the warm up
+        epoch(arg)
+        tracemalloc.start()
+        start = time.perf_counter()
+        epoch(arg)
+        epoch_time = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("{:<13} epoch: {:.4f} s  peak allocated during the epoch: {:.3f} MB".format(name, epoch_time, peak / 2**20))
+
+# +
+# Training epochs with the batches prepared on the training thread vs. prefetched in the background.
+if run_benchmarks:
+    for prefetch in [0, 2]:
+        bench_model = DigitNetwork.from_params(init_params, input_layer_sz, hidden_layer_sz, num_labels, batch_sz)
+        start = time.perf_counter()
+        train_sgd(bench_model, X_train, y_train, 0.1, 3, prefetch=prefetch)
+        print("Prefetch: {}  time per epoch: {:.3f} s".format(prefetch, (time.perf_counter() - start) / 3))
+
+# +
+# Epoch time and validation F1 score training in float64 vs. float32, from the same starting weights and batches.
+if run_benchmarks:
+    for dtype in [np.float64, np.float32]:
+        bench_train = NormalizedView(X_train.X, train_mu, train_sigma, dtype=dtype)
+        bench_val = NormalizedView(X_val.X, train_mu, train_sigma, dtype=dtype)
+        bench_model = DigitNetwork.from_params(init_params, input_layer_sz, hidden_layer_sz, num_labels, batch_sz, dtype=dtype)
+        
+        start = time.perf_counter()
+        Jhist = train_sgd(bench_model, bench_train, y_train, 1, iterations)
+        epoch_time = (time.perf_counter() - start) / iterations
+        
+        fscore = f1_score(y_val, bench_model.predict(bench_val), average='micro')
+        print("{:<8} time per epoch: {:.3f} s  final cost: {:.5f}  F1 score: {:.4f}".format(
+            np.dtype(dtype).name, epoch_time, Jhist[-1], fscore))
 
+# ## Gradient checks and layer profiling
+# Every faster version of the gradient above gets checked against finite differences of the cost on a handful of
+# small random networks, so any future optimization has something to pass. The profiling times the forward pass,
+# backward pass and weight update of each layer inside DigitNetwork and NNLayersCostGradFunction themselves, and
+# compares the FLOP/s to what BLAS manages on a big square matrix product, to show how far each part is from the
+# machine's limit.
 
+# +
+def numerical_gradient(cost, params, epsilon=1e-5):
+    """Central difference approximation of the gradient of cost at params. Two cost evaluations per parameter,
+    so only for small networks."""
+    grad = np.zeros(params.shape)
+    perturbed = np.array(params, dtype=np.float64)
+    for i in range(len(params)):
+        perturbed[i] = params[i] + epsilon
+        cost_plus = cost(perturbed)
+        perturbed[i] = params[i] - epsilon
+        cost_minus = cost(perturbed)
+        perturbed[i] = params[i]
+        grad[i] = (cost_plus - cost_minus) / (2*epsilon)
+    return grad
+
+def relative_error(a, b):
+    return np.linalg.norm(a - b) / max(np.linalg.norm(a + b), 1e-300)
+
+def _digit_network_cost_grad(nn_params, input_layer_sz, hidden_layer_sz, num_labels, X, y, my_lambda=0):
+    # DigitNetwork in the same form as the other functions, for the check.
+    model = DigitNetwork.from_params(nn_params, input_layer_sz, hidden_layer_sz, num_labels, X.shape[0])
+    J = model.cost_grad(X, y)
+    grad = np.concatenate((np.column_stack((model.b1_grad, model.W1_grad)).flatten(),
+                           np.column_stack((model.b2_grad, model.W2_grad)).flatten()))
+    return J, grad
+
+def check_gradients(n_networks=5, seed=0, tolerance=1e-7):
+    """Compare every gradient implementation to finite differences on n_networks small random networks.
+    
+    Each network gets random layer sizes, data, labels and regularization. The two-layer implementations are
+    checked on a two-layer network and NNLayersCostGradFunction on a deeper one with each activation. Returns a
+    DataFrame with the relative error of each check.
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for trial in range(n_networks):
+        m, num_labels = int(rng.integers(5, 30)), int(rng.integers(2, 6))
+        layer_sizes = [int(rng.integers(3, 10))] + list(rng.integers(2, 8, int(rng.integers(1, 4)))) + [num_labels]
+        my_lambda = float(rng.choice([0, rng.uniform(0.1, 3)]))
+        X = rng.standard_normal((m, layer_sizes[0]))
+        y = rng.integers(0, num_labels, m)
+        
+        # The two-layer functions, the loop version never had regularization.
+        sizes = (layer_sizes[0], layer_sizes[1], num_labels)
+        params = init_layer_params([sizes[0], sizes[1], num_labels], seed=trial) + rng.normal(0, 0.5, sizes[1]*(sizes[0]+1) + num_labels*(sizes[1]+1))
+        expected = numerical_gradient(lambda p: NNCostFunction(p, *sizes, X, y, my_lambda), params)
+        for name, grad_function, check_lambda in [
+                ('NNCostGradFunction', lambda p, *args: NNCostGradFunction(p, *args)[1], my_lambda),
+                ('NNGradFunction', NNGradFunction, my_lambda),
+                ('DigitNetwork', lambda p, *args: _digit_network_cost_grad(p, *args)[1], 0),
+                ('NNGradFunction_loop', NNGradFunction_loop, 0)]:
+            if check_lambda != my_lambda:
+                check_expected = numerical_gradient(lambda p: NNCostFunction(p, *sizes, X, y, check_lambda), params)
+            else:
+                check_expected = expected
+            error = relative_error(grad_function(params, *sizes, X, y, check_lambda), check_expected)
+            results.append(dict(network=trial, function=name, layers=list(sizes), activation='sigmoid',
+                                my_lambda=check_lambda, relative_error=error))
+        
+        for activation in ['sigmoid', 'relu']:
+            params = init_layer_params(layer_sizes, activation, seed=trial)
+            params += rng.normal(0, 0.1, params.shape)
+            cost_grad = lambda p: NNLayersCostGradFunction(p, layer_sizes, X, y, my_lambda, activation)
+            error = relative_error(cost_grad(params)[1], numerical_gradient(lambda p: cost_grad(p)[0], params))
+            results.append(dict(network=trial, function='NNLayersCostGradFunction', layers=layer_sizes,
+                                activation=activation, my_lambda=my_lambda, relative_error=error))
+    
+    results = pd.DataFrame(results)
+    results['passed'] = results['relative_error'] < tolerance
+    return results
+
+def blas_peak(n=2048, dtype=np.float64, repeats=5):
+    """FLOP/s of the best of repeats n x n matrix products, about as fast as BLAS gets on this machine."""
+    A = np.random.default_rng(0).standard_normal((n, n)).astype(dtype)
+    B = np.random.default_rng(1).standard_normal((n, n)).astype(dtype)
+    C = np.empty((n, n), dtype=dtype)
+    np.matmul(A, B, out=C)
+    best = min(_time_call(lambda: np.matmul(A, B, out=C)) for _ in range(repeats))
+    return 2 * n**3 / best
+
+def _time_call(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+def profile_layers(layer_sizes, batch_sz=500, activation='sigmoid', dtype=np.float64, repeats=20, peak=None,
+                   alpha=0.01):
+    """Time the forward pass, backward pass and weight update of each layer of a network, on one random batch.
+    
+    This times the real training code through its timings hooks: DigitNetwork for a two-layer sigmoid network (what
+    the training loop uses) and NNLayersCostGradFunction plus the deep network's update for anything else, so the
+    numbers follow any change made to them. Returns a DataFrame with the median time of repeats and the FLOP/s of
+    each step, and the fraction of peak (FLOP/s from blas_peak if it's not given).
+    """
+    if peak is None:
+        peak = blas_peak(dtype=dtype)
+    rng = np.random.default_rng(0)
+    nn_params = init_layer_params(layer_sizes, activation, seed=0).astype(dtype)
+    X = rng.standard_normal((batch_sz, layer_sizes[0])).astype(dtype)
+    y = rng.integers(0, layer_sizes[-1], batch_sz)
+    
+    times = {}
+    if len(layer_sizes) == 3 and activation == 'sigmoid':
+        model = DigitNetwork.from_params(nn_params, *layer_sizes, batch_sz, dtype=dtype)
+        model.timings = times
+        for _ in range(repeats):
+            model.cost_grad(X, y)
+            model.step(alpha)
+    else:
+        for _ in range(repeats):
+            J, grad = NNLayersCostGradFunction(nn_params, layer_sizes, X, y, activation=activation, timings=times)
+            # The deep network's update (deep_params -= deep_alpha*grad), a layer at a time.
+            start = time.perf_counter()
+            for i, (Theta, Theta_grad) in enumerate(zip(unpack_params(nn_params, layer_sizes),
+                                                        unpack_params(grad, layer_sizes))):
+                Theta -= alpha*Theta_grad
+                start = _lap(times, (i, 'update'), start)
+    
+    results = []
+    for i, (n_in, n_out) in enumerate(zip(layer_sizes[:-1], layer_sizes[1:])):
+        gemm = 2 * batch_sz * n_in * n_out
+        # The backward pass has the gradient product, and the delta product for every layer but the first.
+        flops = {'forward': gemm, 'backward': gemm * (2 if i > 0 else 1), 'update': 2 * n_out * (n_in + 1)}
+        for step in ['forward', 'backward', 'update']:
+            seconds = np.median(times[(i, step)])
+            results.append(dict(layer=i + 1, shape='{} -> {}'.format(n_in, n_out), step=step, time_ms=seconds * 1e3,
+                                gflops=flops[step] / seconds / 1e9, fraction_of_peak=flops[step] / seconds / peak))
+    return pd.DataFrame(results)
+
+# +
+if run_gradient_checks:
+    gradient_checks = check_gradients()
+    print(gradient_checks.groupby(['function', 'activation'])['relative_error'].max())
+    assert gradient_checks['passed'].all(), "Gradient check failed:\n" + str(gradient_checks[~gradient_checks['passed']])
+
+# +
+# Where the time goes in each layer of the network being trained, and a wider and deeper one.
+if run_benchmarks:
+    for dtype in [np.float64, np.float32]:
+        peak = blas_peak(dtype=dtype)
+        print("{} BLAS peak: {:.1f} GFLOP/s".format(np.dtype(dtype).name, peak / 1e9))
+        for sizes in [[input_layer_sz, hidden_layer_sz, num_labels], [input_layer_sz, 256, 128, num_labels]]:
+            print(profile_layers(sizes, batch_sz, dtype=dtype, peak=peak).round(3).to_string(index=False))